@@ -221,6 +221,7 @@ setup(
                   (theme_dir + '/static/img', ['src/templates/favicon.ico']),
                   ('etc/openstack-auth-shib', hz_confile_list),
                   ('etc/cron.d', ['config/openstack-auth-shib-cron']),
+                  ('usr/lib/systemd/system', ['config/openstack-auth-shib-scheduler.service']),
                   ('usr/share/openstack-auth-shib', ['config/attribute-map.xml']),
                   ('etc/openstack-auth-shib/notifications', ['config/notifications_en.txt']),
                   (theme_dir + '/static', 
@@ -0,0 +1,326 @@
+#  Copyright (c) 2014 INFN - "Istituto Nazionale di Fisica Nucleare" - Italy
+#  All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+import logging
+import math
+import os
+import random
+import socket
+import threading
+import time
+
+from datetime import datetime
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db import connections
+from django.db import router
+from django.db import transaction
+from django.db import IntegrityError
+from django.utils import timezone
+from django.core.management import load_command_class
+from django.core.management.base import CommandError
+from openstack_auth_shib.models import CronLock
+
+from horizon.management.commands.cronscript_utils import CloudVenetoCommand
+
+LOG = logging.getLogger("aaischeduler")
+
+#
+# Jobs in order of execution: (name, interval, offset) in seconds.
+# The slots of a job start at offset from the local midnight (from the
+# midnight of Monday for the intervals longer than a day) and repeat
+# every interval, as the lines of the former crontab
+#
+DEFAULT_JOBS = [
+    ('checkexpiration', 86400, 300),
+    ('notifyexpiration', 86400, 600),
+    ('renewalrequest', 86400, 900),
+    ('pendingsubscr', 604800, 32400),
+    ('sendnotifications', 300, 0),
+    ('indexlogs', 600, 0),
+    ('purgelogs', 86400, 3600)
+]
+
+#
+# Jobs not executed unless removed from AAISCHEDULER_DISABLED_JOBS:
+# the retention of the logs (purgelogs) must be enabled explicitly
+#
+DEFAULT_DISABLED_JOBS = [ 'purgelogs' ]
+
+MAX_SLEEP = 60
+
+class ScheduledJob():
+
+    def __init__(self, name, interval, offset):
+        self.name = name
+        self.interval = interval
+        self.offset = offset
+        self.done_slot = 0
+        self.n_runs = 0
+        self.n_failures = 0
+        self.last_time = 0.0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def current_slot(self, now_ts):
+        now_dt = datetime.fromtimestamp(now_ts)
+        anchor_day = now_dt.date()
+        if self.interval > 86400:
+            anchor_day -= timedelta(days=now_dt.weekday())
+        anchor = time.mktime(anchor_day.timetuple()) + self.offset
+        return anchor + math.floor((now_ts - anchor) / self.interval) * self.interval
+
+    def record(self, elapsed, failed):
+        self.n_runs += 1
+        if failed:
+            self.n_failures += 1
+        self.last_time = elapsed
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+    def stats(self):
+        avg_time = self.total_time / self.n_runs if self.n_runs else 0.0
+        return "%s: runs=%d failures=%d last=%.1fs avg=%.1fs max=%.1fs" % \
+            (self.name, self.n_runs, self.n_failures, self.last_time, avg_time, self.max_time)
+
+#
+# Extends the lease of the running job until stopped
+#
+class LeaseKeeper(threading.Thread):
+
+    def __init__(self, job_name, node_id, lock_time):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.job_name = job_name
+        self.node_id = node_id
+        self.lock_time = lock_time
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stopped.wait(self.lock_time / 3.0):
+                try:
+                    q_args = {
+                        'command' : self.job_name,
+                        'owner' : self.node_id
+                    }
+                    new_exp = timezone.now() + timedelta(seconds=self.lock_time)
+                    if CronLock.objects.filter(**q_args).update(expires=new_exp) == 0:
+                        LOG.error("Lost the lease of job %s" % self.job_name)
+                except:
+                    LOG.error("Cannot extend the lease of job %s" % self.job_name, exc_info=True)
+        finally:
+            connections.close_all()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+#
+# Lock of a job shared by the nodes of the cluster: the owner takes a lease
+# renewed while the job is running, the start time of the last execution
+# is recorded in lastrun
+#
+class JobLock():
+
+    def __init__(self, job, owner):
+        self.job = job
+        self.owner = owner
+        self.lock_time = getattr(settings, 'AAISCHEDULER_LOCK_TIMEOUT', 3600)
+        self.lease_keeper = None
+
+    def _get_lock(self):
+        try:
+            c_lock, created = CronLock.objects.get_or_create(command=self.job.name)
+        except IntegrityError:
+            # created by another node in the meantime
+            c_lock = CronLock.objects.get(command=self.job.name)
+        return c_lock
+
+    def get_lastrun(self):
+        return self._get_lock().lastrun
+
+    def acquire(self, slot, force=False):
+        now = timezone.now()
+        slot_time = datetime.fromtimestamp(slot, timezone.utc)
+        if not timezone.is_aware(now):
+            slot_time = timezone.make_naive(slot_time)
+
+        self._get_lock()
+
+        with transaction.atomic(using=router.db_for_write(CronLock)):
+            c_lock = CronLock.objects.select_for_update().get(command=self.job.name)
+            if c_lock.owner and c_lock.expires > now:
+                LOG.info("Job %s is locked by %s" % (self.job.name, c_lock.owner))
+                return False
+            if not force and c_lock.lastrun and c_lock.lastrun >= slot_time:
+                LOG.info("Job %s already executed for this slot" % self.job.name)
+                return False
+            c_lock.owner = self.owner
+            c_lock.expires = now + timedelta(seconds=self.lock_time)
+            c_lock.save()
+
+        self.lease_keeper = LeaseKeeper(self.job.name, self.owner, self.lock_time)
+        self.lease_keeper.start()
+        return True
+
+    def release(self, start_time):
+        self.lease_keeper.stop()
+        q_args = {
+            'command' : self.job.name,
+            'owner' : self.owner
+        }
+        CronLock.objects.filter(**q_args).update(owner='', lastrun=start_time)
+
+def get_node_id():
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+#
+# Returns the job scheduled with the given name, None if the job
+# is not scheduled or it is disabled
+#
+def get_job(name):
+    disabled_jobs = getattr(settings, 'AAISCHEDULER_DISABLED_JOBS', DEFAULT_DISABLED_JOBS)
+    for job_name, interval, offset in getattr(settings, 'AAISCHEDULER_JOBS', DEFAULT_JOBS):
+        if job_name == name and not job_name in disabled_jobs:
+            return ScheduledJob(job_name, interval, offset)
+    return None
+
+class Command(CloudVenetoCommand):
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('--once',
+                            dest='once',
+                            action='store_true',
+                            default=False,
+                            help='Run all the jobs once and exit')
+
+    def _get_jitter(self, job):
+        #
+        # The same fraction for all the jobs of the node keeps their order
+        #
+        max_jitter = getattr(settings, 'AAISCHEDULER_JITTER', 300)
+        return self.jitter_ratio * min(max_jitter, job.interval / 2.0)
+
+    def _init_slot(self, job):
+        #
+        # A job never executed in the cluster waits for its next slot,
+        # otherwise the slot missed while the scheduler was down is recovered
+        #
+        if JobLock(job, self.node_id).get_lastrun() is None:
+            job.done_slot = job.current_slot(time.time())
+
+    def _run_job(self, job, slot, force=False):
+        close_old_connections()
+
+        job_lock = JobLock(job, self.node_id)
+        try:
+            if not job_lock.acquire(slot, force):
+                return
+        except:
+            LOG.error("Cannot lock job %s" % job.name, exc_info=True)
+            return
+
+        failed = False
+        start_time = time.time()
+        run_time = timezone.now()
+        try:
+            LOG.info("Running %s" % job.name)
+            job_cmd = load_command_class('horizon', job.name)
+            #
+            # The job uses the keystone session of the scheduler
+            #
+            job_cmd.keystone_session = self.keystone_session
+
+            cmd_args = list()
+            if self.conffile:
+                cmd_args = [ '--config', self.conffile ]
+            if self.workers:
+                cmd_args += [ '--workers', str(self.workers) ]
+            options = vars(job_cmd.create_parser('manage.py', job.name).parse_args(cmd_args))
+            job_cmd.handle(**options)
+
+        except CommandError as cmd_err:
+            failed = True
+            LOG.error("Job %s failed: %s" % (job.name, cmd_err))
+        except:
+            failed = True
+            LOG.error("Job %s failed" % job.name, exc_info=True)
+        finally:
+            job.record(time.time() - start_time, failed)
+            try:
+                job_lock.release(run_time)
+            except:
+                LOG.error("Cannot unlock job %s" % job.name, exc_info=True)
+            close_old_connections()
+
+        LOG.info(job.stats())
+
+    def handle(self, *args, **options):
+
+        super(Command, self).handle(options)
+
+        self.conffile = options.get('conffile', None)
+        self.workers = options.get('workers', None)
+        self.node_id = get_node_id()
+        self.jitter_ratio = random.random()
+
+        try:
+            #
+            # A single keystone session for all the jobs, the token
+            # is renewed by the session when it expires
+            #
+            self.get_keystone_client()
+        except:
+            LOG.error("Cannot create keystone session", exc_info=True)
+            raise CommandError("Cannot create keystone session")
+
+        disabled_jobs = getattr(settings, 'AAISCHEDULER_DISABLED_JOBS', DEFAULT_DISABLED_JOBS)
+        job_list = list()
+        for name, interval, offset in getattr(settings, 'AAISCHEDULER_JOBS', DEFAULT_JOBS):
+            if name in disabled_jobs:
+                LOG.info("Job %s disabled" % name)
+                continue
+            job_list.append(ScheduledJob(name, interval, offset))
+
+        if options['once']:
+            for job in job_list:
+                self._run_job(job, job.current_slot(time.time()), True)
+            return
+
+        for job in job_list:
+            self._init_slot(job)
+            LOG.info("Job %s scheduled every %d s, jitter %.0f s"
+                     % (job.name, job.interval, self._get_jitter(job)))
+
+        while True:
+            next_run = time.time() + MAX_SLEEP
+            for job in job_list:
+                now = time.time()
+                slot = job.current_slot(now)
+                run_at = slot + self._get_jitter(job)
+                if slot > job.done_slot and now >= run_at:
+                    self._run_job(job, slot)
+                    job.done_slot = slot
+                elif slot > job.done_slot:
+                    next_run = min(next_run, run_at)
+                else:
+                    next_run = min(next_run, slot + job.interval + self._get_jitter(job))
+
+            time.sleep(min(max(next_run - time.time(), 1), MAX_SLEEP))
+
@@ -0,0 +1,87 @@
+#  Copyright (c) 2014 INFN - "Istituto Nazionale di Fisica Nucleare" - Italy
+#  All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+import logging
+
+from django.db import connections
+from django.db import router
+from django.db import transaction
+from django.core.management.base import CommandError
+from openstack_auth_shib.models import Registration
+from openstack_auth_shib.models import Project
+from openstack_auth_shib.models import Expiration
+from openstack_auth_shib.models import PrjRequest
+from openstack_auth_shib.models import PrjRole
+
+from horizon.management.commands.cronscript_utils import CloudVenetoCommand
+
+LOG = logging.getLogger("backfillids")
+
+RELATION_MODELS = (Expiration, PrjRequest, PrjRole)
+
+#
+# Adds the userid and projectid columns of Expiration, PrjRequest and PrjRole
+# to the tables of an existing installation, then fills them in with
+# a single UPDATE per column. The correlated subqueries are expressed
+# in SQL, OuterRef and Subquery are not available before Django 1.11
+#
+class Command(CloudVenetoCommand):
+
+    def _fill_column(self, cursor, model, column, src_model, src_column, src_key, rel_field):
+        qn = connections[router.db_for_write(model)].ops.quote_name
+        table = qn(model._meta.db_table)
+        src_table = qn(src_model._meta.db_table)
+        sql_stm = "UPDATE %s SET %s = (SELECT %s FROM %s WHERE %s.%s = %s.%s) WHERE %s IS NULL" % (
+            table, qn(column),
+            qn(src_column), src_table, src_table, qn(src_key),
+            table, qn(model._meta.get_field(rel_field).column),
+            qn(column)
+        )
+        cursor.execute(sql_stm)
+        LOG.info("Updated %s in %d rows of %s" % (column, cursor.rowcount, model._meta.db_table))
+
+    def _add_columns(self, model):
+        conn = connections[router.db_for_write(model)]
+        with conn.cursor() as cursor:
+            curr_columns = set(x.name for x in conn.introspection.get_table_description(
+                cursor, model._meta.db_table))
+
+        with conn.schema_editor() as editor:
+            for f_name in ('userid', 'projectid'):
+                field = model._meta.get_field(f_name)
+                if not field.column in curr_columns:
+                    LOG.info("Adding column %s to %s" % (field.column, model._meta.db_table))
+                    editor.add_field(model, field)
+
+    def handle(self, *args, **options):
+
+        super(Command, self).handle(options)
+
+        try:
+            for model in RELATION_MODELS:
+                self._add_columns(model)
+
+            db_name = router.db_for_write(Registration)
+            with transaction.atomic(using=db_name):
+                with connections[db_name].cursor() as cursor:
+                    for model in RELATION_MODELS:
+                        self._fill_column(cursor, model, 'userid',
+                                          Registration, 'userid', 'regid', 'registration')
+                        self._fill_column(cursor, model, 'projectid',
+                                          Project, 'projectid', 'projectname', 'project')
+        except:
+            LOG.error("Cannot backfill ids", exc_info=True)
+            raise CommandError("Cannot backfill ids")
+
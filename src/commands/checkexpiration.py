@@ -14,29 +14,43 @@
 #  under the License. 
 
 import logging
+import operator
 
 from datetime import datetime, timedelta
 
 from django.db import transaction
+from django.utils import timezone
+from django.db.models import Count
+from django.db.models import Q
 from django.core.management.base import CommandError
-from openstack_auth_shib.models import Registration
 from openstack_auth_shib.models import Expiration
+from openstack_auth_shib.models import Project
 from openstack_auth_shib.models import PrjRequest
 from openstack_auth_shib.models import EMail
 from openstack_auth_shib.models import PrjRole
 
 from openstack_auth_shib.notifications import notifyUser
 from openstack_auth_shib.notifications import notifyAdmin
+from openstack_auth_shib.notifications import NotificationBatch
 from openstack_auth_shib.notifications import USER_EXPIRED_TYPE
 from openstack_auth_shib.notifications import CHANGED_MEMBER_ROLE
 
 from horizon.management.commands.cronscript_utils import CloudVenetoCommand
 from horizon.management.commands.cronscript_utils import get_prjman_roleid
-
-from keystoneclient.v3 import client
+from horizon.management.commands.cronscript_utils import parallel_map
 
 LOG = logging.getLogger("checkexpiration")
 
+#
+# Max number of (registration, project) pairs in a single delete statement
+#
+PAIRS_PER_QUERY = 200
+
+def pair_filter(exp_list):
+    return reduce(operator.or_, [
+        Q(registration_id=x.registration_id, project_id=x.project_id) for x in exp_list
+    ])
+
 class Command(CloudVenetoCommand):
 
     def handle(self, *args, **options):
@@ -44,71 +58,133 @@ class Command(CloudVenetoCommand):
         super(Command, self).handle(options)
         
         LOG.info("Checking expired users")
+
+        self.begin_run()
+
         try:
 
-            keystone_client = client.Client(username=self.config.cron_user,
-                                            password=self.config.cron_pwd,
-                                            project_name=self.config.cron_prj,
-                                            user_domain_name=self.config.cron_domain,
-                                            project_domain_name=self.config.cron_domain,
-                                            cacert=self.config.cron_ca,
-                                            auth_url=self.config.cron_kurl)
+            keystone_client = self.get_keystone_client()
 
             prjman_roleid = get_prjman_roleid(keystone_client)
-            cloud_adminid = keystone_client.auth_ref.user_id
+            cloud_adminid = self.keystone_session.get_user_id()
+
+            exp_date = timezone.now() - timedelta(self.config.cron_defer)
+
+            #
+            # Load all the expired memberships, they are processed in batches
+            # ordered by id; a new run in the same day resumes from the last batch,
+            # retries the failed memberships and processes the ones expired
+            # after the previous run (expdate not earlier than its snapshot)
+            #
+            exp_list = list(Expiration.objects.filter(expdate__lt=exp_date)
+                                              .select_related('registration', 'project'))
 
         except:
             LOG.error("Check expiration failed", exc_info=True)
+            self.end_run(True, "Check expiration failed")
             raise CommandError("Check expiration failed")
 
-        updated_prjs = set()
-
-        exp_date = datetime.now() - timedelta(self.config.cron_defer)
-
-        for mem_item in Expiration.objects.filter(expdate__lt=exp_date):
-
-            username = mem_item.registration.username
-            userid = mem_item.registration.userid
-            prjname = mem_item.project.projectname
-            prjid = mem_item.project.projectid
-
-            updated_prjs.add(prjid)
-
-            try:
-                with transaction.atomic():
-
-                    tmpres = EMail.objects.filter(registration=mem_item.registration)
-                    user_mail = tmpres[0].email if len(tmpres) else None
+        if len(exp_list) == 0:
+            LOG.info("No expired users")
+            self.end_run(message="No expired users")
+            return
 
-                    q_args = {
-                        'registration' : mem_item.registration,
-                        'project' : mem_item.project
-                    }
-                    Expiration.objects.filter(**q_args).delete()
-                    PrjRequest.objects.filter(**q_args).delete()
-                    PrjRole.objects.filter(**q_args).delete()
+        def _process_batch(batch):
+            failed_list = self._process_expired([ x[1] for x in batch ], keystone_client,
+                                                prjman_roleid, cloud_adminid)
+            return [ "%012d" % x.id for x in failed_list ]
 
-                    arg_dict = { 'project' : prjid, 'user' : userid }
-                    for r_item in keystone_client.role_assignments.list(**arg_dict):
-                        keystone_client.roles.revoke(r_item.role['id'], **arg_dict)
+        try:
+            units = [ ("%012d" % x.id, x) for x in exp_list ]
+            n_done, n_failed = self.run_checkpointed(datetime.now().date().isoformat(),
+                                                     units, _process_batch,
+                                                     snapshot=exp_date,
+                                                     item_time=lambda x: x.expdate)
+            LOG.info("Removed %d memberships, %d failures" % (n_done, n_failed))
+        except:
+            LOG.error("Check expiration failed", exc_info=True)
+            self.end_run(True, "Check expiration failed")
+            raise CommandError("Check expiration failed")
+        self.end_run()
 
-                    LOG.info("Removed %s from %s" % (username, prjid))
+    def _process_expired(self, exp_list, keystone_client, prjman_roleid, cloud_adminid):
 
-                noti_params = { 'username' : username, 'project' : prjname }
-                notifyUser(user_mail, USER_EXPIRED_TYPE, noti_params,
-                           project_id=prjid, dst_user_id=userid)
-                #
-                # TODO notify project admins
-                #
+        mail_table = dict()
+        q_args = {
+            'registration__in' : set(x.registration_id for x in exp_list)
+        }
+        for email_item in EMail.objects.filter(**q_args).order_by('id'):
+            if not email_item.registration_id in mail_table:
+                mail_table[email_item.registration_id] = email_item.email
 
-            except:
-                LOG.error("Check expiration failed for %s" % username, exc_info=True)
+        #
+        # Revoke the roles in keystone, the requests are spread over the workers
+        #
+        def _revoke_roles(mem_item):
+            arg_dict = {
+                'project' : mem_item.project.projectid,
+                'user' : mem_item.registration.userid
+            }
+            for r_item in keystone_client.role_assignments.list(**arg_dict):
+                keystone_client.roles.revoke(r_item.role['id'], **arg_dict)
+
+        removed_list = list()
+        failed_list = list()
+        for mem_item, res, err in parallel_map(_revoke_roles, exp_list, self.config.cron_workers):
+            if err:
+                failed_list.append(mem_item)
+                LOG.error("Check expiration failed for %s" % mem_item.registration.username)
+            else:
+                removed_list.append(mem_item)
+                LOG.info("Removed %s from %s" % (mem_item.registration.username,
+                                                mem_item.project.projectid))
+
+        if len(removed_list) == 0:
+            return failed_list
 
         #
-        # Check for tenants without admin (use cloud admin if missing)
+        # Clean up the database for all the revoked memberships
         #
-        for prj_id in updated_prjs:
-            if PrjRole.objects.filter(project__projectid=prj_id).count() == 0:
+        try:
+            with transaction.atomic():
+                for idx in range(0, len(removed_list), PAIRS_PER_QUERY):
+                    q_pairs = pair_filter(removed_list[idx:idx + PAIRS_PER_QUERY])
+                    Expiration.objects.filter(q_pairs).delete()
+                    PrjRequest.objects.filter(q_pairs).delete()
+                    PrjRole.objects.filter(q_pairs).delete()
+        except:
+            LOG.error("Cannot remove expired memberships", exc_info=True)
+            raise CommandError("Check expiration failed")
+
+        with NotificationBatch():
+
+            for mem_item in removed_list:
+                try:
+                    noti_params = {
+                        'username' : mem_item.registration.username,
+                        'project' : mem_item.project.projectname
+                    }
+                    notifyUser(mail_table.get(mem_item.registration_id), USER_EXPIRED_TYPE,
+                               noti_params, project_id=mem_item.project.projectid,
+                               dst_user_id=mem_item.registration.userid)
+                    #
+                    # TODO notify project admins
+                    #
+                except:
+                    LOG.error("Cannot notify %s" % mem_item.registration.username, exc_info=True)
+
+            #
+            # Check for tenants without admin (use cloud admin if missing)
+            #
+            q_args = {
+                'projectid__in' : set(x.project.projectid for x in removed_list)
+            }
+            orphan_prjs = Project.objects.filter(**q_args) \
+                                         .annotate(num_of_admins=Count('prjrole')) \
+                                         .filter(num_of_admins=0) \
+                                         .values_list('projectid', flat=True)
+
+            for prj_id in orphan_prjs:
                 try:
                     keystone_client.roles.grant(prjman_roleid, user=cloud_adminid, project=prj_id)
                     LOG.info("Cloud Administrator as admin for %s" % prj_id)
@@ -119,6 +195,7 @@ class Command(CloudVenetoCommand):
                     }
                     notifyAdmin(CHANGED_MEMBER_ROLE, noti_params, dst_user_id=prj_id)
                 except:
-                    LOG.error("Cannot set super admin for %s" % username, exc_info=True)
+                    LOG.error("Cannot set super admin for %s" % prj_id, exc_info=True)
 
+        return failed_list
 
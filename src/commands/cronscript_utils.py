@@ -13,11 +13,26 @@
 #  License for the specific language governing permissions and limitations
 #  under the License. 
 
+import json
 import logging
 import logging.config
+import time
+
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from openstack_auth_shib.models import CronRun
+from openstack_auth_shib.models import CronCheckpoint
+from openstack_auth_shib.models import CSTATUS_DONE
+from openstack_auth_shib.models import CSTATUS_FAILED
+
+from keystoneauth1.identity import v3 as v3_auth
+from keystoneauth1 import session as ks_session
+from keystoneclient.v3 import client
 
 LOG = logging.getLogger("cronscript_utils")
 
@@ -34,6 +49,55 @@ class CloudVenetoCommand(BaseCommand):
                             action='store',
                             default=None,
                             help='The configuration file for the logging system')
+        parser.add_argument('--workers',
+                            dest='workers',
+                            action='store',
+                            type=int,
+                            default=None,
+                            help='The number of concurrent requests to the remote services')
+        parser.add_argument('--force',
+                            dest='force',
+                            action='store_true',
+                            default=False,
+                            help='Run a job of the scheduler even if already executed in its slot')
+
+    #
+    # A job of the scheduler started by cron or by hand takes the lock of the
+    # scheduler: it is skipped if the job is running on another node or it
+    # has already been executed in the current slot, so the cron lines and
+    # the scheduler can be active together.
+    # The jobs started by the scheduler call handle() directly
+    #
+    def execute(self, *args, **options):
+        # imported here, aaischeduler depends on this module
+        from horizon.management.commands.aaischeduler import get_job
+        from horizon.management.commands.aaischeduler import get_node_id
+        from horizon.management.commands.aaischeduler import JobLock
+
+        job = get_job(self.get_command_name())
+        if job is None:
+            return super(CloudVenetoCommand, self).execute(*args, **options)
+
+        logconffile = options.get('logconffile', None)
+        if logconffile:
+            logging.config.fileConfig(logconffile)
+
+        job_lock = JobLock(job, get_node_id())
+        run_time = timezone.now()
+        try:
+            if not job_lock.acquire(job.current_slot(time.time()), options.get('force', False)):
+                return
+        except:
+            LOG.error("Cannot lock job %s, running unlocked" % job.name, exc_info=True)
+            return super(CloudVenetoCommand, self).execute(*args, **options)
+
+        try:
+            return super(CloudVenetoCommand, self).execute(*args, **options)
+        finally:
+            try:
+                job_lock.release(run_time)
+            except:
+                LOG.error("Cannot unlock job %s" % job.name, exc_info=True)
 
     def handle(self, options):
 
@@ -57,6 +121,131 @@ class CloudVenetoCommand(BaseCommand):
                 self.config.cron_renewd = int(params.get('RENEW_DAYS', '30'))
                 self.config.cron_defer = int(params.get('DEFER_DAYS', '0'))
                 self.config.cron_plan = params.get('NOTIFICATION_PLAN', None)
+                self.config.cron_workers = int(params.get('WORKERS', self.config.cron_workers))
+
+        workers = options.get('workers', None)
+        if workers:
+            self.config.cron_workers = workers
+        self.config.cron_workers = max(self.config.cron_workers, 1)
+
+    def get_keystone_client(self):
+        #
+        # The session is shared by all the clients created by the command
+        # and it is safe to be used by the worker threads
+        #
+        if not getattr(self, 'keystone_session', None):
+            auth = v3_auth.Password(auth_url=self.config.cron_kurl,
+                                    username=self.config.cron_user,
+                                    password=self.config.cron_pwd,
+                                    project_name=self.config.cron_prj,
+                                    user_domain_name=self.config.cron_domain,
+                                    project_domain_name=self.config.cron_domain)
+            self.keystone_session = ks_session.Session(auth=auth,
+                                                       verify=self.config.cron_ca or True)
+        return client.Client(session=self.keystone_session)
+
+    def get_command_name(self):
+        return self.__module__.split('.')[-1]
+
+    #
+    # Records the execution of the command, the history older than
+    # CRON_HISTORY_DAYS is removed together with the expired checkpoints
+    #
+    def begin_run(self):
+        command = self.get_command_name()
+        old_date = timezone.now() - timedelta(getattr(settings, 'CRON_HISTORY_DAYS', 90))
+
+        with transaction.atomic():
+            CronCheckpoint.objects.filter(command=command, updated__lt=old_date).delete()
+            CronRun.objects.filter(command=command, started__lt=old_date).delete()
+            self.cron_run = CronRun.objects.create(command=command)
+        return self.cron_run
+
+    def end_run(self, failed=False, message=None):
+        cron_run = getattr(self, 'cron_run', None)
+        if cron_run is None:
+            return
+
+        try:
+            cron_run.status = CSTATUS_FAILED if failed else CSTATUS_DONE
+            cron_run.finished = timezone.now()
+            cron_run.message = message
+            cron_run.save()
+        except:
+            LOG.error("Cannot record the execution of %s" % cron_run.command, exc_info=True)
+
+    #
+    # Processes in batches the items not yet covered by the checkpoint of the cycle.
+    # units is a list of (key, item) with unique string keys, the batches follow the
+    # order of the keys; process_func takes the list of (key, item) of a batch and
+    # returns the keys of the failed items.
+    # The mark is moved forward after each batch, the failed keys are recorded in
+    # the checkpoint and processed again by the next run of the cycle; if
+    # process_func raises an exception the batch is processed again by the next run.
+    # If item_time is given, an item below the mark is processed again when
+    # item_time(item) is not earlier than the snapshot of the previous run, that is
+    # the item was not yet eligible when the previous run selected its items
+    #
+    def run_checkpointed(self, cycle, units, process_func, batch_size=None,
+                         snapshot=None, item_time=None):
+        if batch_size is None:
+            batch_size = getattr(settings, 'CRON_BATCH_SIZE', 100)
+        batch_size = max(batch_size, 1)
+        if snapshot is None:
+            snapshot = timezone.now()
+
+        checkpoint, created = CronCheckpoint.objects.get_or_create(
+            command=self.get_command_name(),
+            cycle=cycle,
+            defaults={ 'mark' : '' }
+        )
+        failed_keys = set(json.loads(checkpoint.failed or '[]'))
+        last_snapshot = checkpoint.snapshot
+
+        def _pending(key, item):
+            if key > checkpoint.mark or key in failed_keys:
+                return True
+            return item_time is not None and last_snapshot is not None \
+                and item_time(item) >= last_snapshot
+
+        units = sorted([ x for x in units if _pending(*x) ], key=lambda x: x[0])
+        if not created and len(units):
+            LOG.info("Resuming %s from %s (%d failed)" % (cycle, checkpoint.mark, len(failed_keys)))
+
+        n_processed = 0
+        n_failed = 0
+        cron_run = getattr(self, 'cron_run', None)
+
+        for idx in range(0, len(units), batch_size):
+            batch = units[idx:idx + batch_size]
+            batch_failed = set(process_func(batch))
+
+            n_processed += len(batch) - len(batch_failed)
+            n_failed += len(batch_failed)
+
+            failed_keys.difference_update(x[0] for x in batch)
+            failed_keys.update(batch_failed)
+
+            checkpoint.mark = max(checkpoint.mark, batch[-1][0])
+            checkpoint.failed = json.dumps(sorted(failed_keys))
+            checkpoint.updated = timezone.now()
+            checkpoint.run = cron_run
+            checkpoint.save()
+
+            if cron_run:
+                cron_run.processed = n_processed
+                cron_run.failed = n_failed
+                cron_run.save()
+
+        #
+        # The snapshot is moved forward only when all the pending items
+        # have been processed
+        #
+        checkpoint.snapshot = snapshot
+        checkpoint.updated = timezone.now()
+        checkpoint.save()
+
+        return (n_processed, n_failed)
 
     def _readParameters(self, conffile):
         result = dict()
@@ -96,7 +285,33 @@ class ConfigBin:
         self.cron_renewd = getattr(settings, 'CRON_RENEW_DAYS', 30)
         self.cron_defer = getattr(settings, 'CRON_DEFER_DAYS', 0)
         self.cron_plan = getattr(settings, 'NOTIFICATION_PLAN', None)
+        self.cron_workers = getattr(settings, 'CRON_WORKERS', 1)
 
 def build_contact_list():
     return getattr(settings, 'MANAGERS', None)
 
+#
+# Applies func to each item using a pool of workers;
+# returns the list of tuples (item, result, exception) in the same order of items,
+# exception is None if func succeeded
+#
+def parallel_map(func, items, workers=1):
+
+    def _wrapped(item):
+        try:
+            return (item, func(item), None)
+        except Exception as exc:
+            LOG.error("Parallel task failed for %s" % str(item), exc_info=True)
+            return (item, None, exc)
+
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return map(_wrapped, items)
+
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(_wrapped, items)
+    finally:
+        pool.close()
+        pool.join()
+
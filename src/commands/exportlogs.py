@@ -0,0 +1,96 @@
+#  Copyright (c) 2014 INFN - "Istituto Nazionale di Fisica Nucleare" - Italy
+#  All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+import logging
+import sys
+
+from datetime import datetime, timedelta
+
+from django.utils import timezone
+from django.core.management.base import CommandError
+from openstack_auth_shib.models import Log
+from openstack_auth_shib.logexport import export_logs
+from openstack_auth_shib.logexport import EXPORT_FORMATS
+from openstack_auth_shib.logexport import DEFAULT_CHUNK
+
+from horizon.management.commands.cronscript_utils import CloudVenetoCommand
+
+LOG = logging.getLogger("exportlogs")
+
+def parse_day(value):
+    return timezone.make_aware(datetime.strptime(value, "%Y-%m-%d"), timezone.utc)
+
+class Command(CloudVenetoCommand):
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('--start',
+                            dest='start',
+                            action='store',
+                            default=None,
+                            help='First day of the export (YYYY-MM-DD)')
+        parser.add_argument('--end',
+                            dest='end',
+                            action='store',
+                            default=None,
+                            help='Last day of the export (YYYY-MM-DD)')
+        parser.add_argument('--format',
+                            dest='format',
+                            action='store',
+                            choices=EXPORT_FORMATS.keys(),
+                            default='csv',
+                            help='The format of the exported data')
+        parser.add_argument('--output',
+                            dest='output',
+                            action='store',
+                            default=None,
+                            help='The output file (default: standard output)')
+        parser.add_argument('--chunk',
+                            dest='chunk',
+                            action='store',
+                            type=int,
+                            default=DEFAULT_CHUNK,
+                            help='The number of rows read per query')
+
+    def handle(self, *args, **options):
+
+        super(Command, self).handle(options)
+
+        try:
+            filters = dict()
+            if options.get('start', None):
+                filters['timestamp__gte'] = parse_day(options['start'])
+            if options.get('end', None):
+                filters['timestamp__lt'] = parse_day(options['end']) + timedelta(days=1)
+        except ValueError:
+            raise CommandError("Wrong date format")
+
+        out_file = open(options['output'], 'w') if options.get('output', None) else sys.stdout
+
+        try:
+            n_rows = 0
+            for line in export_logs(Log.objects.filter(**filters), options['format'],
+                                    max(options['chunk'], 1)):
+                out_file.write(line)
+                n_rows += 1
+            out_file.flush()
+            LOG.info("Exported %d lines" % n_rows)
+        except:
+            LOG.error("Cannot export logs", exc_info=True)
+            raise CommandError("Cannot export logs")
+        finally:
+            if out_file is not sys.stdout:
+                out_file.close()
+
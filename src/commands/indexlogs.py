@@ -0,0 +1,57 @@
+#  Copyright (c) 2014 INFN - "Istituto Nazionale di Fisica Nucleare" - Italy
+#  All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+import logging
+
+from django.core.management.base import CommandError
+from openstack_auth_shib.logsearch import get_search_backend
+
+from horizon.management.commands.cronscript_utils import CloudVenetoCommand
+
+LOG = logging.getLogger("indexlogs")
+
+class Command(CloudVenetoCommand):
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('--setup',
+                            dest='setup',
+                            action='store_true',
+                            default=False,
+                            help='Create the full text index')
+        parser.add_argument('--batch',
+                            dest='batch',
+                            action='store',
+                            type=int,
+                            default=1000,
+                            help='The max number of logs indexed per statement')
+
+    def handle(self, *args, **options):
+
+        super(Command, self).handle(options)
+
+        backend = get_search_backend(options['setup'])
+
+        try:
+            if options['setup']:
+                LOG.info("Creating full text index with %s" % backend.__class__.__name__)
+                backend.setup()
+
+            n_indexed = backend.update_index(max(options['batch'], 1))
+            LOG.info("Indexed %d logs" % n_indexed)
+        except:
+            LOG.error("Cannot index logs", exc_info=True)
+            raise CommandError("Cannot index logs")
+
@@ -16,13 +16,16 @@
 import logging
 
 from datetime import datetime
+from datetime import time
 from datetime import timedelta
 
+from django.utils import timezone
 from django.core.management.base import CommandError
 from openstack_auth_shib.models import Expiration
 from openstack_auth_shib.models import EMail
 from openstack_auth_shib.models import PrjRole
-from openstack_auth_shib.notifications import notifyUser
+from openstack_auth_shib.notifications import NotificationBatch
+from openstack_auth_shib.notifications import NotificationDigest
 from openstack_auth_shib.notifications import USER_EXP_TYPE
 
 from horizon.management.commands.cronscript_utils import CloudVenetoCommand
@@ -47,73 +50,123 @@ class Command(CloudVenetoCommand):
             result.append(20)
         return result
     
-    def handle(self, *args, **options):
+    def _local_date(self, value):
+        if timezone.is_aware(value):
+            return timezone.localtime(value).date()
+        return value.date()
+
+    def _day_start(self, day):
+        result = datetime.combine(day, time.min)
+        if timezone.is_aware(timezone.now()):
+            result = timezone.make_aware(result)
+        return result
 
-        super(Command, self).handle(options)
+    #
+    # Yields a notification job for each expiration matching a day of the plan:
+    # the expirations of all the days are loaded with a single range query
+    # and bucketed by local date, admins and email addresses with one query each
+    #
+    def _plan_notifications(self, plan_days, today):
+
+        day_table = dict()
+        for days_to_exp in plan_days:
+            day_table[today + timedelta(days=days_to_exp)] = days_to_exp
+
+        q_args = {
+            'expdate__gte' : self._day_start(today + timedelta(days=min(plan_days))),
+            'expdate__lt' : self._day_start(today + timedelta(days=max(plan_days) + 1))
+        }
+        q_fields = ('expdate', 'registration__username', 'registration__userid',
+                    'project_id', 'project__projectid')
+
+        exp_list = list()
+        user_set = set()
+        prj_set = set()
+        for expdate, username, userid, prjname, prjid in Expiration.objects.filter(**q_args) \
+                .values_list(*q_fields):
+
+            days_to_exp = day_table.get(self._local_date(expdate), None)
+            if days_to_exp is None:
+                continue
+
+            exp_list.append((days_to_exp, username, userid, prjname, prjid))
+            user_set.add(userid)
+            prj_set.add(prjname)
+
+        if len(exp_list) == 0:
+            return
+
+        admin_table = dict((x, list()) for x in prj_set)
+        for prjname, userid in PrjRole.objects.filter(project_id__in=prj_set) \
+                                              .values_list('project_id', 'userid'):
+            admin_table[prjname].append(userid)
+            user_set.add(userid)
+
+        mail_table = dict(EMail.objects.filter(registration__userid__in=user_set)
+                                       .values_list('registration__userid', 'email'))
+
+        for days_to_exp, username, userid, prjname, prjid in exp_list:
+            contacts = [ mail_table[x] for x in admin_table[prjname] if x in mail_table ]
+            yield (days_to_exp, username, userid, prjname, prjid, mail_table.get(userid, None), contacts)
 
-        try:
+    def handle(self, *args, **options):
 
-            now = datetime.now()
-            noti_table = dict()
-            user_set = set()
-            prj_set = set()
+        super(Command, self).handle(options)
 
-            for days_to_exp in self._get_days_to_exp(self.config.cron_plan):
+        self.begin_run()
 
-                tframe = now + timedelta(days=days_to_exp)
-                noti_table[days_to_exp] = list()
+        try:
 
-                q_args = {
-                    'expdate__gte' : tframe.replace(hour=0, minute=0, second=0, microsecond=0),
-                    'expdate__lte' : tframe.replace(hour=23, minute=59, second=59, microsecond=999999)
+            today = self._local_date(timezone.now())
+            plan_days = self._get_days_to_exp(self.config.cron_plan)
+
+            #
+            # The notifications are grouped by recipient, a new run in the same day
+            # skips the recipients already notified
+            #
+            rcpt_table = dict()
+            for days_to_exp, username, userid, prjname, prjid, email, contacts in \
+                self._plan_notifications(plan_days, today):
+
+                if not email:
+                    LOG.error("Cannot notify %s: missing email address" % username)
+                    continue
+
+                noti_params = {
+                    'username' : username,
+                    'project' : prjname,
+                    'days' : days_to_exp,
+                    'contacts' : contacts
                 }
-
-                for exp_item in Expiration.objects.filter(**q_args):
-
-                    username = exp_item.registration.username
-                    userid = exp_item.registration.userid
-                    prjname = exp_item.project.projectname
-                    prjid = exp_item.project.projectid
-
-                    noti_table[days_to_exp].append((username, userid, prjname, prjid))
-                    user_set.add(userid)
-                    prj_set.add(prjname)
-
-            admin_table = dict()
-            for p_role in PrjRole.objects.filter(project__projectname__in=prj_set):
-                prjname = p_role.project.projectname
-                if not admin_table.has_key(prjname):
-                    admin_table[prjname] = list()
-                admin_table[prjname].append(p_role.registration.userid)
-                user_set.add(p_role.registration.userid)
-
-            mail_table = dict()
-            for email_item in EMail.objects.filter(registration__userid__in=user_set):
-                mail_table[email_item.registration.userid] = email_item.email
-
-            contact_table = dict()
-            for prjname, uid_list in admin_table.items():
-                contact_table[prjname] = list()
-                for userid in uid_list:
-                    if mail_table.has_key(userid):
-                        contact_table[prjname].append(mail_table[userid])
-
-            for days_to_exp, noti_list in noti_table.items():
-                for username, userid, prjname, prjid in noti_list:
-                    try:
-                        noti_params = {
-                            'username' : username,
-                            'project' : prjname,
-                            'days' : days_to_exp,
-                            'contacts' : contact_table[prjname]
-                        }
-                        notifyUser(mail_table[userid], USER_EXP_TYPE, noti_params,
-                                   user_id=userid, project_id=prjid, dst_user_id=userid)
-                    except:
-                        LOG.error("Cannot notify %s" % username, exc_info=True)
+                noti_args = {
+                    'user_id' : userid,
+                    'project_id' : prjid,
+                    'dst_user_id' : userid
+                }
+                if not email in rcpt_table:
+                    rcpt_table[email] = list()
+                rcpt_table[email].append((email, noti_params, noti_args))
+
+            #
+            # A recipient is failed if the digest cannot be rendered or
+            # the message is refused by the mail server
+            #
+            def _notify_batch(batch):
+                digest = NotificationDigest(USER_EXP_TYPE)
+                for rcpt, noti_list in batch:
+                    for email, noti_params, noti_args in noti_list:
+                        digest.addUser(email, noti_params, **noti_args)
+                with NotificationBatch() as noti_batch:
+                    digest.send()
+                failed_rcpts = noti_batch.failed_rcpts.union(digest.failed_rcpts)
+                return [ x[0] for x in batch if x[0] in failed_rcpts ]
+
+            self.run_checkpointed(today.isoformat(), rcpt_table.items(), _notify_batch)
                 
         except:
             LOG.error("Notification failed", exc_info=True)
+            self.end_run(True, "Notification failed")
             raise CommandError("Notification failed")
 
+        self.end_run()
 
@@ -15,6 +15,8 @@
 
 import logging
 
+from datetime import datetime
+
 from django.db import transaction
 from django.conf import settings
 from django.core.management.base import CommandError
@@ -23,7 +25,8 @@ from openstack_auth_shib.models import RegRequest
 from openstack_auth_shib.models import EMail
 from openstack_auth_shib.models import PrjRole
 from openstack_auth_shib.models import PSTATUS_PENDING
-from openstack_auth_shib.notifications import notifyUser
+from openstack_auth_shib.notifications import NotificationBatch
+from openstack_auth_shib.notifications import NotificationDigest
 from openstack_auth_shib.notifications import SUBSCR_REMINDER
 
 from horizon.management.commands.cronscript_utils import CloudVenetoCommand
@@ -40,6 +43,8 @@ class Command(CloudVenetoCommand):
         mail_table = dict()
         req_table = dict()
 
+        self.begin_run()
+
         try:
             with transaction.atomic():
 
@@ -65,21 +70,40 @@ class Command(CloudVenetoCommand):
                             if len(tmpres):
                                 mail_table[user_name] = tmpres[0].email
 
+            #
+            # One reminder per admin per week, a new run in the same week
+            # skips the admins already notified
+            #
+            units = list()
             for user_tuple in admin_table:
-                for prj_name in admin_table[user_tuple]:
-                    try:
+                if not mail_table.has_key(user_tuple[0]):
+                    LOG.error("Cannot notify pending subscription: %s" % user_tuple[0])
+                    continue
+                units.append((user_tuple[0], user_tuple))
+
+            def _notify_batch(batch):
+                digest = NotificationDigest(SUBSCR_REMINDER)
+                for user_name, user_tuple in batch:
+                    for prj_name in admin_table[user_tuple]:
                         noti_params = {
                             'pendingreqs' : req_table[prj_name],
                             'project' : prj_name
                         }
-                        notifyUser(mail_table[user_tuple[0]], SUBSCR_REMINDER, noti_params,
-                                   dst_user_id=user_tuple[1])
-                    except:
-                        LOG.error("Cannot notify pending subscription: %s" % user_tuple[0], 
-                                  exc_info=True)
+                        digest.addUser(mail_table[user_tuple[0]], noti_params,
+                                       dst_user_id=user_tuple[1])
+                with NotificationBatch() as noti_batch:
+                    digest.send()
+                failed_rcpts = noti_batch.failed_rcpts.union(digest.failed_rcpts)
+                return [ x[0] for x in batch if mail_table[x[0]] in failed_rcpts ]
+
+            iso_year, iso_week, iso_day = datetime.now().isocalendar()
+            self.run_checkpointed("%d-W%02d" % (iso_year, iso_week), units, _notify_batch)
 
         except:
             LOG.error("Cannot notify pending subscritions: system error", exc_info=True)
+            self.end_run(True, "Cannot notify pending subscritions")
             raise CommandError("Cannot notify pending subscritions")
 
+        self.end_run()
+
 
@@ -22,12 +22,11 @@ from openstack_auth_shib.models import Project
 from openstack_auth_shib.models import Expiration
 from openstack_auth_shib.models import EMail
 from openstack_auth_shib.models import PrjRole
+from openstack_auth_shib.models import invalidate_prjman_cache
 
 from horizon.management.commands.cronscript_utils import CloudVenetoCommand
 from horizon.management.commands.cronscript_utils import get_prjman_roleid
 
-from keystoneclient.v3 import client
-
 LOG = logging.getLogger("populatexpiration")
 
 class Command(CloudVenetoCommand):
@@ -44,100 +43,122 @@ class Command(CloudVenetoCommand):
                 if prj_item.projectid:
                     prj_dict[prj_item.projectid] = prj_item
 
+            reg_dict = dict()
+
+            for reg_user in Registration.objects.all():
+                if reg_user.userid:
+                    reg_dict[reg_user.userid] = reg_user
+                else:
+                    LOG.info("Skipped unregistered user %s" % reg_user.username)
+
+            keystone_client = self.get_keystone_client()
+            tnt_admin_roleid = get_prjman_roleid(keystone_client)
+
             #
-            # TODO define the user_domain_name and project_domain_name
+            # Snapshot of the role assignments and users from keystone,
+            # indexed by user id
             #
-            keystone_client = client.Client(username=self.config.cron_user,
-                                            password=self.config.cron_pwd,
-                                            project_name=self.config.cron_prj,
-                                            cacert=self.config.cron_ca,
-                                            user_domain_name=self.config.cron_domain,
-                                            project_domain_name=self.config.cron_domain,
-                                            auth_url=self.config.cron_kurl)
+            LOG.info("Retrieving role assignments and users")
+
+            assign_table = dict()
+            for r_item in keystone_client.role_assignments.list():
+                if not hasattr(r_item, 'user') or not 'project' in r_item.scope:
+                    continue
+                tmpuid = r_item.user['id']
+                tmppid = r_item.scope['project']['id']
+                if not tmpuid in reg_dict:
+                    continue
+                if not tmppid in prj_dict:
+                    LOG.info("Skipped unregistered project %s for %s" % \
+                    (tmppid, reg_dict[tmpuid].username))
+                    continue
+                if not tmpuid in assign_table:
+                    assign_table[tmpuid] = dict()
+                if not tmppid in assign_table[tmpuid]:
+                    assign_table[tmpuid][tmppid] = set()
+                assign_table[tmpuid][tmppid].add(r_item.role['id'])
+
+            ks_user_table = dict()
+            for ks_user in keystone_client.users.list():
+                ks_user_table[ks_user.id] = ks_user
 
             LOG.info("Populating the expiration table")
 
             with transaction.atomic():
-                for reg_user in Registration.objects.all():
-                
-                    if not reg_user.userid:
-                        LOG.info("Skipped unregistered user %s" % reg_user.username)
-                        continue
-                    
-                    for r_item in keystone_client.role_assignments.list(user=reg_user.userid):
-                        if not r_item.scope['project']['id'] in prj_dict:
-                            LOG.info("Skipped unregistered project %s for %s" % \
-                            (r_item.scope['project']['id'], reg_user.username))
-                        curr_prj = prj_dict[r_item.scope['project']['id']]
-                        
-                        if Expiration.objects.filter(
-                            registration=reg_user,
-                            project=curr_prj
-                        ).count() > 0:
+
+                curr_exps = set(Expiration.objects.values_list('registration_id', 'project_id'))
+
+                new_exps = list()
+                for userid, prj_roles in assign_table.items():
+                    reg_user = reg_dict[userid]
+                    for prjid in prj_roles:
+                        curr_prj = prj_dict[prjid]
+                        if (reg_user.regid, curr_prj.projectname) in curr_exps:
                             continue
 
-                        prj_exp = Expiration()
-                        prj_exp.registration = reg_user
-                        prj_exp.project = curr_prj
-                        prj_exp.expdate = reg_user.expdate
-                        prj_exp.save()
-                        
+                        new_exps.append(Expiration(
+                            registration=reg_user,
+                            project=curr_prj,
+                            userid=reg_user.userid,
+                            projectid=curr_prj.projectid,
+                            expdate=reg_user.expdate
+                        ))
+
                         LOG.info("Imported expiration for %s in %s: %s" % \
                         (reg_user.username, curr_prj.projectname, \
                         reg_user.expdate.strftime("%A, %d. %B %Y %I:%M%p")))
 
+                Expiration.objects.bulk_create(new_exps)
+
             LOG.info("Populating the email table")
 
             with transaction.atomic():
-                for reg_user in Registration.objects.all():
 
-                    if not reg_user.userid:
-                        LOG.info("Skipped unregistered user %s" % reg_user.username)
-                        continue
+                curr_mails = set(EMail.objects.values_list('registration_id', flat=True))
 
-                    tmpres = keystone_client.users.get(reg_user.userid)
-                    if not tmpres:
+                new_mails = list()
+                for userid, reg_user in reg_dict.items():
+
+                    if reg_user.regid in curr_mails:
                         continue
 
-                    if EMail.objects.filter(registration=reg_user).count() > 0:
+                    ks_user = ks_user_table.get(userid, None)
+                    tmpmail = getattr(ks_user, 'email', None) if ks_user else None
+                    if not tmpmail:
                         continue
 
-                    mail_obj = EMail()
-                    mail_obj.registration = reg_user
-                    mail_obj.email = tmpres.email
-                    mail_obj.save()
+                    new_mails.append(EMail(registration=reg_user, email=tmpmail))
 
-                    LOG.info("Imported email for %s: %s" % (reg_user.username, tmpres.email))
+                    LOG.info("Imported email for %s: %s" % (reg_user.username, tmpmail))
 
-            LOG.info("Populating the project roles table")
+                EMail.objects.bulk_create(new_mails)
 
-            tnt_admin_roleid = get_prjman_roleid(keystone_client)
+            LOG.info("Populating the project roles table")
 
             with transaction.atomic():
 
                 PrjRole.objects.all().delete()
 
-                prj_dict = dict()
-                for prj_obj in Project.objects.all():
-                    prj_dict[prj_obj.projectid] = prj_obj
+                new_roles = list()
+                for userid, prj_roles in assign_table.items():
+                    reg_user = reg_dict[userid]
+                    for prjid, role_set in prj_roles.items():
+                        if not tnt_admin_roleid in role_set:
+                            continue
 
-                for reg_user in Registration.objects.all():
+                        new_roles.append(PrjRole(
+                            registration=reg_user,
+                            project=prj_dict[prjid],
+                            userid=reg_user.userid,
+                            projectid=prjid,
+                            roleid=tnt_admin_roleid
+                        ))
 
-                    if not reg_user.userid:
-                        LOG.info("Skipped unregistered user %s" % reg_user.username)
-                        continue
+                        LOG.info("Imported admin %s for %s" % (reg_user.username, 
+                                 prj_dict[prjid].projectname))
 
-                    for role_obj in keystone_client.role_assignments.list(reg_user.userid):
-                        if role_obj.role['id'] == tnt_admin_roleid:
-                            tmpprjid = role_obj.scope['project']['id']
-                            prjRole = PrjRole()
-                            prjRole.registration = reg_user
-                            prjRole.project = prj_dict[tmpprjid]
-                            prjRole.roleid = role_obj.role['id']
-                            prjRole.save()
-
-                            LOG.info("Imported admin %s for %s" % (reg_user.username, 
-                                     prj_dict[tmpprjid].projectname))
+                PrjRole.objects.bulk_create(new_roles)
+                invalidate_prjman_cache(prj_dict.keys())
 
         except:
             LOG.error("Import failed", exc_info=True)
@@ -0,0 +1,197 @@
+#  Copyright (c) 2014 INFN - "Istituto Nazionale di Fisica Nucleare" - Italy
+#  All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+import logging
+import gzip
+import json
+import os
+import os.path
+
+from datetime import timedelta
+
+from django.db import transaction
+from django.conf import settings
+from django.utils import timezone
+from django.core.management.base import CommandError
+from openstack_auth_shib.models import Log
+from openstack_auth_shib.models import LogExtra
+from openstack_auth_shib.logexport import get_extra_table
+from openstack_auth_shib.logexport import log_to_dict
+from openstack_auth_shib.logsearch import get_search_backend
+
+from horizon.management.commands.cronscript_utils import CloudVenetoCommand
+
+LOG = logging.getLogger("purgelogs")
+
+#
+# Archive files are partitioned by day: <archive dir>/<year>/logs-<year>-<month>-<day>.jsonl.gz
+# Each run appends a new gzip member, the result can be read with zcat.
+# The logs are archived in timestamp order, so only the file of the current
+# day is kept open.
+# The ids of the archived batch are recorded in the pending file until the
+# batch is deleted from the database, after a crash the next run deletes
+# them without archiving them again
+#
+PENDING_FILE = '.purge-pending'
+
+class LogArchive():
+
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        self.curr_day = None
+        self.curr_file = None
+
+    def _get_file(self, day):
+        if day != self.curr_day:
+            self.close()
+            year_dir = os.path.join(self.archive_dir, "%04d" % day.year)
+            if not os.path.isdir(year_dir):
+                os.makedirs(year_dir, 0o750)
+            filename = os.path.join(year_dir, "logs-%s.jsonl.gz" % day.isoformat())
+            self.curr_file = gzip.open(filename, 'ab')
+            self.curr_day = day
+        return self.curr_file
+
+    def write(self, log, extra):
+        day = log.timestamp.date()
+        self._get_file(day).write(json.dumps(log_to_dict(log, extra)) + '\n')
+
+    def flush(self):
+        if self.curr_file:
+            self.curr_file.flush()
+            os.fsync(self.curr_file.fileobj.fileno())
+
+    def close(self):
+        if self.curr_file:
+            self.curr_file.close()
+        self.curr_day = None
+        self.curr_file = None
+
+    def _pending_path(self):
+        return os.path.join(self.archive_dir, PENDING_FILE)
+
+    def get_pending(self):
+        if not os.path.exists(self._pending_path()):
+            return list()
+        with open(self._pending_path()) as p_file:
+            return json.load(p_file)
+
+    def set_pending(self, log_ids):
+        if not os.path.isdir(self.archive_dir):
+            os.makedirs(self.archive_dir, 0o750)
+        tmp_path = self._pending_path() + '.tmp'
+        with open(tmp_path, 'w') as p_file:
+            json.dump(log_ids, p_file)
+            p_file.flush()
+            os.fsync(p_file.fileno())
+        os.rename(tmp_path, self._pending_path())
+
+    def clear_pending(self):
+        if os.path.exists(self._pending_path()):
+            os.remove(self._pending_path())
+
+class Command(CloudVenetoCommand):
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('--days',
+                            dest='days',
+                            action='store',
+                            type=int,
+                            default=getattr(settings, 'LOG_MANAGER_RETENTION_DAYS', 365),
+                            help='The number of days the logs are kept in the database')
+        parser.add_argument('--archive-dir',
+                            dest='archivedir',
+                            action='store',
+                            default=getattr(settings, 'LOG_MANAGER_ARCHIVE_DIR',
+                                            '/var/lib/openstack-auth-shib/logs'),
+                            help='The directory for the archived logs')
+        parser.add_argument('--no-archive',
+                            dest='noarchive',
+                            action='store_true',
+                            default=False,
+                            help='Delete the logs without archiving them')
+        parser.add_argument('--batch',
+                            dest='batch',
+                            action='store',
+                            type=int,
+                            default=1000,
+                            help='The max number of logs removed per transaction')
+
+    def _delete_logs(self, log_ids, search_backend):
+        #
+        # LogExtra refers to Log with on_delete=PROTECT
+        #
+        with transaction.atomic():
+            LogExtra.objects.filter(log_id__in=log_ids).delete()
+            Log.objects.filter(id__in=log_ids).delete()
+            search_backend.remove(log_ids)
+
+    def handle(self, *args, **options):
+
+        super(Command, self).handle(options)
+
+        if options['days'] < 1:
+            raise CommandError("Wrong retention period")
+
+        batch_size = max(options['batch'], 1)
+        exp_date = timezone.now() - timedelta(days=options['days'])
+        archive = None if options['noarchive'] else LogArchive(options['archivedir'])
+        search_backend = get_search_backend()
+
+        LOG.info("Purging logs older than %s" % exp_date.isoformat())
+
+        n_purged = 0
+
+        try:
+            if archive:
+                log_ids = archive.get_pending()
+                if len(log_ids):
+                    LOG.info("Removing %d logs archived by a previous run" % len(log_ids))
+                    self._delete_logs(log_ids, search_backend)
+                    archive.clear_pending()
+
+            while True:
+                log_list = list(Log.objects.filter(timestamp__lt=exp_date)
+                                           .order_by('timestamp', 'id')[:batch_size])
+                if len(log_list) == 0:
+                    break
+
+                log_ids = [ x.id for x in log_list ]
+
+                if archive:
+                    extra_table = get_extra_table(log_ids)
+                    for log in log_list:
+                        archive.write(log, extra_table.get(log.id, {}))
+                    archive.flush()
+                    archive.set_pending(log_ids)
+
+                self._delete_logs(log_ids, search_backend)
+
+                if archive:
+                    archive.clear_pending()
+
+                n_purged += len(log_ids)
+                LOG.debug("Purged %d logs" % n_purged)
+
+        except:
+            LOG.error("Cannot purge logs", exc_info=True)
+            raise CommandError("Cannot purge logs")
+        finally:
+            if archive:
+                archive.close()
+
+        LOG.info("Purged %d logs" % n_purged)
+
@@ -28,8 +28,8 @@ from openstack_auth_shib.models import PrjRole
 from openstack_auth_shib.models import PSTATUS_RENEW_ADMIN
 from openstack_auth_shib.models import PSTATUS_RENEW_MEMB
 
-from openstack_auth_shib.notifications import notifyProject
-from openstack_auth_shib.notifications import notifyAdmin
+from openstack_auth_shib.notifications import NotificationBatch
+from openstack_auth_shib.notifications import NotificationDigest
 from openstack_auth_shib.notifications import USER_NEED_RENEW
 
 from horizon.management.commands.cronscript_utils import CloudVenetoCommand
@@ -47,6 +47,11 @@ class Command(CloudVenetoCommand):
 
         LOG.info("Checking for renewal after %s" % str(exp_date))
 
+        #
+        # The requests already issued are skipped, a rerun only does the remaining work
+        #
+        self.begin_run()
+
         try:
 
             new_reqs = dict()
@@ -91,24 +96,28 @@ class Command(CloudVenetoCommand):
                             tmpl.append(tmpobj[0].email)
                     mail_table[req_pair[1].projectname] = tmpl
 
+            digest = NotificationDigest(USER_NEED_RENEW)
             for req_pair, req_data in new_reqs.items():
-                try:
-                    noti_params = {
-                        'username' : req_pair[0].username,
-                        'project' : req_pair[1].projectname
-                    }
-                    if req_data[0]:
-                        notifyAdmin(USER_NEED_RENEW, noti_params, user_id=req_pair[0].userid,
+                noti_params = {
+                    'username' : req_pair[0].username,
+                    'project' : req_pair[1].projectname
+                }
+                if req_data[0]:
+                    digest.addAdmin(noti_params, user_id=req_pair[0].userid,
                                     project_id=req_pair[1].projectid,
                                     dst_project_id=req_pair[1].projectid)
-                    else:
-                        notifyProject(mail_table[req_pair[1].projectname], USER_NEED_RENEW,
-                                      noti_params, user_id=req_pair[0].userid,
+                else:
+                    digest.addProject(mail_table[req_pair[1].projectname], noti_params,
+                                      user_id=req_pair[0].userid,
                                       project_id=req_pair[1].projectid,
                                       dst_project_id=req_pair[1].projectid)
-                except:
-                    LOG.error("Cannot notify %s" % req_pair[0].username, exc_info=True)
+
+            with NotificationBatch():
+                digest.send()
         except:
             LOG.error("Renewal request failed", exc_info=True)
+            self.end_run(True, "Renewal request failed")
             raise CommandError("Renewal request failed")
 
+        self.end_run()
+
@@ -0,0 +1,209 @@
+#  Copyright (c) 2014 INFN - "Istituto Nazionale di Fisica Nucleare" - Italy
+#  All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+import logging
+import json
+
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+
+from django.db import transaction
+from django.conf import settings
+from django.utils import timezone
+from django.core.mail import EmailMessage
+from django.core.mail import get_connection
+from django.core.mail import mail_managers
+from django.core.management.base import CommandError
+from openstack_auth_shib.models import OutMail
+from openstack_auth_shib.models import MSTATUS_QUEUED
+from openstack_auth_shib.models import MSTATUS_SENT
+from openstack_auth_shib.models import MSTATUS_FAILED
+
+from horizon.management.commands.cronscript_utils import CloudVenetoCommand
+
+LOG = logging.getLogger("sendnotifications")
+
+#
+# Time reserved to a worker for delivering a claimed message,
+# after that the message can be picked up by another run.
+# It is much longer than the period of the job (5 minutes), so that a slow
+# run never loses its claims to the next one; the claims of a crashed run
+# are recovered after the timeout
+#
+CLAIM_TIMEOUT = 3600
+
+def deliver_mail(mail_item, connection):
+    try:
+        if mail_item.tomanagers:
+            mail_managers(mail_item.subject, mail_item.body, connection=connection)
+        else:
+            recipients = json.loads(mail_item.recipients)
+            sender = mail_item.sender or settings.SERVER_EMAIL
+            EmailMessage(mail_item.subject, mail_item.body, sender, recipients,
+                         connection=connection).send()
+        return (mail_item.id, None)
+    except Exception as exc:
+        LOG.debug("Cannot deliver message %d" % mail_item.id, exc_info=True)
+        return (mail_item.id, str(exc))
+
+#
+# Each worker delivers its share of the claimed batch through a single
+# SMTP connection, a failure affects only the current message
+#
+def deliver_chunk(mail_chunk):
+    result = list()
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as exc:
+        LOG.debug("Cannot open the mail connection", exc_info=True)
+        return [ (x.id, str(exc)) for x in mail_chunk ]
+
+    try:
+        for mail_item in mail_chunk:
+            result.append(deliver_mail(mail_item, connection))
+    finally:
+        try:
+            connection.close()
+        except:
+            LOG.debug("Cannot close the mail connection", exc_info=True)
+    return result
+
+class Command(CloudVenetoCommand):
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('--batch',
+                            dest='batch',
+                            action='store',
+                            type=int,
+                            default=getattr(settings, 'NOTIFICATION_QUEUE_BATCH', 100),
+                            help='The max number of messages claimed per iteration')
+        parser.add_argument('--retention',
+                            dest='retention',
+                            action='store',
+                            type=int,
+                            default=getattr(settings, 'NOTIFICATION_QUEUE_RETENTION_DAYS', 30),
+                            help='The number of days the sent or discarded messages are kept')
+
+    def _claim(self, batch_size):
+        now = timezone.now()
+
+        with transaction.atomic():
+            q_args = {
+                'status' : MSTATUS_QUEUED,
+                'nextattempt__lte' : now
+            }
+            mail_list = list(OutMail.objects.select_for_update()
+                                            .filter(**q_args)
+                                            .order_by('nextattempt')[:batch_size])
+            if len(mail_list):
+                OutMail.objects.filter(id__in=[ x.id for x in mail_list ]).update(
+                    nextattempt=now + timedelta(seconds=CLAIM_TIMEOUT)
+                )
+        return mail_list
+
+    def _update(self, mail_list, results):
+        now = timezone.now()
+        max_retry = getattr(settings, 'NOTIFICATION_QUEUE_MAX_RETRY', 5)
+        backoff = getattr(settings, 'NOTIFICATION_QUEUE_BACKOFF', 60)
+        mail_table = dict((x.id, x) for x in mail_list)
+        sent_ids = list()
+
+        with transaction.atomic():
+            for mail_id, err_msg in results:
+                if err_msg is None:
+                    sent_ids.append(mail_id)
+                    continue
+
+                mail_item = mail_table[mail_id]
+                mail_item.attempts += 1
+                mail_item.lasterror = err_msg
+                if mail_item.attempts >= max_retry:
+                    mail_item.status = MSTATUS_FAILED
+                    LOG.error("Discarded message %d: %s" % (mail_id, err_msg))
+                else:
+                    delay = backoff * (2 ** (mail_item.attempts - 1))
+                    mail_item.nextattempt = now + timedelta(seconds=delay)
+                    LOG.warning("Delivery of message %d deferred: %s" % (mail_id, err_msg))
+                mail_item.save()
+
+            if len(sent_ids):
+                OutMail.objects.filter(id__in=sent_ids).update(
+                    status=MSTATUS_SENT,
+                    sentdate=now,
+                    lasterror=None
+                )
+
+        return len(sent_ids)
+
+    #
+    # Removes the messages delivered or discarded before the retention period
+    #
+    def _purge(self, retention):
+        if retention < 1:
+            return 0
+        q_args = {
+            'status__in' : [ MSTATUS_SENT, MSTATUS_FAILED ],
+            'created__lt' : timezone.now() - timedelta(days=retention)
+        }
+        n_purged, tmpd = OutMail.objects.filter(**q_args).delete()
+        return n_purged
+
+    def handle(self, *args, **options):
+
+        super(Command, self).handle(options)
+
+        workers = options.get('workers', None)
+        if not workers:
+            workers = getattr(settings, 'NOTIFICATION_QUEUE_WORKERS', self.config.cron_workers)
+        workers = max(workers, 1)
+        batch_size = max(options.get('batch', 1), 1)
+
+        n_sent = 0
+        n_failed = 0
+        pool = ThreadPool(workers)
+
+        try:
+            while True:
+                mail_list = self._claim(batch_size)
+                if len(mail_list) == 0:
+                    break
+
+                chunks = [ mail_list[i::workers] for i in range(workers) ]
+                results = list()
+                for tmpres in pool.map(deliver_chunk, [ x for x in chunks if len(x) ]):
+                    results += tmpres
+                tmpn = self._update(mail_list, results)
+                n_sent += tmpn
+                n_failed += len(mail_list) - tmpn
+
+        except:
+            LOG.error("Cannot deliver notifications", exc_info=True)
+            raise CommandError("Cannot deliver notifications")
+        finally:
+            pool.close()
+            pool.join()
+
+        LOG.info("Delivered %d messages, %d deferred or discarded" % (n_sent, n_failed))
+
+        try:
+            n_purged = self._purge(options.get('retention', 0))
+            if n_purged:
+                LOG.info("Removed %d old messages from the outbox" % n_purged)
+        except:
+            LOG.error("Cannot purge the outbox", exc_info=True)
+            raise CommandError("Cannot purge the outbox")
+
@@ -0,0 +1,117 @@
+#  Copyright (c) 2014 INFN - "Istituto Nazionale di Fisica Nucleare" - Italy
+#  All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+import logging
+
+from django.db import connections
+from django.db import router
+from django.db.models import Count
+from django.core.management.base import CommandError
+from openstack_auth_shib.models import Expiration
+from openstack_auth_shib.models import PrjRequest
+from openstack_auth_shib.models import PrjRole
+from openstack_auth_shib.models import Log
+from openstack_auth_shib.models import PRJROLE_INDEXES
+from openstack_auth_shib.models import PRJREQ_INDEXES
+from openstack_auth_shib.models import LOG_INDEXES
+
+from horizon.management.commands.cronscript_utils import CloudVenetoCommand
+
+LOG = logging.getLogger("updateindexes")
+
+#
+# The application has no migrations, the tables of a new installation
+# are created with the indexes declared in the models; this command adds
+# the missing ones to the tables of an existing installation.
+# The indexes are created with explicit SQL statements, Meta.indexes
+# is not available before Django 1.11
+#
+INDEXED_MODELS = [
+    (Expiration, ()),
+    (PrjRequest, PRJREQ_INDEXES),
+    (PrjRole, PRJROLE_INDEXES),
+    (Log, LOG_INDEXES)
+]
+
+def get_columns(model, field_names):
+    return tuple(model._meta.get_field(x).column for x in field_names)
+
+class Command(CloudVenetoCommand):
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('--dry-run',
+                            dest='dryrun',
+                            action='store_true',
+                            default=False,
+                            help='Print the SQL statements without executing them')
+
+    def _update_model(self, model, index_specs, dry_run):
+        db_name = router.db_for_write(model)
+        conn = connections[db_name]
+
+        with conn.cursor() as cursor:
+            constraints = conn.introspection.get_constraints(cursor, model._meta.db_table).values()
+        indexed = set(tuple(x['columns']) for x in constraints if x['index'] or x['unique'])
+        uniques = set(tuple(x['columns']) for x in constraints if x['unique'])
+
+        new_indexes = list()
+        for idx_name, fields in index_specs:
+            columns = get_columns(model, fields)
+            if not columns in indexed:
+                new_indexes.append((idx_name, columns))
+
+        new_uniques = list()
+        for fields in model._meta.unique_together:
+            if get_columns(model, fields) in uniques:
+                continue
+
+            dup_count = model.objects.using(db_name).values(*fields) \
+                                     .annotate(num_of_rows=Count('pk')) \
+                                     .filter(num_of_rows__gt=1).count()
+            if dup_count:
+                LOG.error("Cannot create unique constraint %s on %s: %d duplicated entries"
+                          % (",".join(fields), model._meta.db_table, dup_count))
+                continue
+            new_uniques.append(tuple(fields))
+
+        with conn.schema_editor(collect_sql=dry_run, atomic=False) as editor:
+            for idx_name, columns in new_indexes:
+                LOG.info("Creating index %s on %s" % (idx_name, model._meta.db_table))
+                editor.execute(editor.sql_create_index % {
+                    'name' : editor.quote_name(idx_name),
+                    'table' : editor.quote_name(model._meta.db_table),
+                    'columns' : ", ".join(editor.quote_name(x) for x in columns),
+                    'extra' : ''
+                })
+            if len(new_uniques):
+                LOG.info("Creating unique constraints on %s" % model._meta.db_table)
+                editor.alter_unique_together(model, [], new_uniques)
+
+        if dry_run:
+            for sql_stm in editor.collected_sql:
+                self.stdout.write(sql_stm)
+
+    def handle(self, *args, **options):
+
+        super(Command, self).handle(options)
+
+        try:
+            for model, index_specs in INDEXED_MODELS:
+                self._update_model(model, index_specs, options['dryrun'])
+        except:
+            LOG.error("Cannot update indexes", exc_info=True)
+            raise CommandError("Cannot update indexes")
+
@@ -37,7 +37,7 @@ class LogFilterAction(tables.FilterAction):
         ("project_id", _("Project ID ="), True),
         ("user_name", _("User Name ="), True),
         ("user_id", _("User ID ="), True),
-        ("message__icontains", _("Full text"), True),
+        ("fulltext", _("Full text"), True),
     )
 
 
@@ -119,5 +119,7 @@ class MainTable(tables.DataTable):
     class Meta(object):
         name = "logs"
         verbose_name = _("Logs")
+        pagination_param = "log_marker"
+        prev_pagination_param = "prev_log_marker"
         multi_select = False
         table_actions = (LogFilterAction, )
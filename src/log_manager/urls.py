@@ -22,6 +22,7 @@ from openstack_dashboard.dashboards.idmanager.log_manager import views
 
 index_url = url(r'^$', views.MainView.as_view(), name='index')
 detail_url = url(r'^(?P<log_id>[^/]+)/detail/$', views.DetailView.as_view(), name='detail')
+export_url = url(r'^export/$', views.ExportView.as_view(), name='export')
 
 if django_version[1] < 11:
 
@@ -33,12 +34,14 @@ if django_version[1] < 11:
         prefix,
         index_url,
         detail_url,
+        export_url,
     )
 
 else:
 
     urlpatterns = [
         index_url,
-        detail_url
+        detail_url,
+        export_url
     ]
     
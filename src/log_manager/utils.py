@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#  Copyright (c) 2017 INFN - "Istituto Nazionale di Fisica Nucleare" - Italy
+#  All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from openstack_dashboard import api
+
+from openstack_auth_shib.models import Registration
+from openstack_auth_shib.models import Project
+
+
+LOG = logging.getLogger(__name__)
+
+
+# Process-wide id -> name table, bounded in size and in time.
+# A None value records an id that cannot be resolved, so that it is
+# not looked up again until the entry expires.
+class NameCache(object):
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.table = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.table.pop(key, None)
+            if item is None:
+                return False, None
+            if item[1] < time.time():
+                return False, None
+            # re-insert as the most recently used
+            self.table[key] = item
+            return True, item[0]
+
+    def put(self, key, value):
+        with self.lock:
+            self.table.pop(key, None)
+            self.table[key] = (value, time.time() + self.ttl)
+            while len(self.table) > self.max_size:
+                self.table.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.table.clear()
+
+
+CACHE_SIZE = getattr(settings, 'LOG_MANAGER_NAME_CACHE_SIZE', 10000)
+CACHE_TTL = getattr(settings, 'LOG_MANAGER_NAME_CACHE_TTL', 600)
+
+USER_NAMES = NameCache(CACHE_SIZE, CACHE_TTL)
+PROJECT_NAMES = NameCache(CACHE_SIZE, CACHE_TTL)
+
+
+# Resolves user and project names for the log panel.
+# Missing ids are resolved in bulk with a single keystone listing,
+# then with the local Registration and Project tables.
+class NameResolver(object):
+
+    def __init__(self, request):
+        self.request = request
+
+    def _missing(self, cache, ids):
+        return set(x for x in ids if x and not cache.get(x)[0])
+
+    def _load_users(self, user_ids):
+        found = dict()
+        try:
+            if len(user_ids) == 1:
+                user_list = [ api.keystone.user_get(self.request, list(user_ids)[0]) ]
+            else:
+                user_list = api.keystone.user_list(self.request)
+            for user in user_list:
+                if user.id in user_ids:
+                    found[user.id] = user.name
+                else:
+                    USER_NAMES.put(user.id, user.name)
+        except Exception as e:
+            LOG.error('Failed to get users: %s' % e)
+
+        missing = user_ids - set(found)
+        if missing:
+            q_args = {'userid__in': missing}
+            for userid, username in Registration.objects.filter(**q_args) \
+                                                       .values_list('userid', 'username'):
+                found[userid] = username
+
+        for user_id in user_ids:
+            USER_NAMES.put(user_id, found.get(user_id, None))
+
+    def _load_projects(self, project_ids):
+        found = dict()
+        try:
+            if len(project_ids) == 1:
+                projects = [ api.keystone.tenant_get(self.request, list(project_ids)[0]) ]
+            else:
+                projects, has_more = api.keystone.tenant_list(self.request)
+            for project in projects:
+                if project.id in project_ids:
+                    found[project.id] = project.name
+                else:
+                    PROJECT_NAMES.put(project.id, project.name)
+        except Exception as e:
+            LOG.error('Failed to get projects: %s' % e)
+
+        missing = project_ids - set(found)
+        if missing:
+            q_args = {'projectid__in': missing}
+            for projectid, projectname in Project.objects.filter(**q_args) \
+                                                         .values_list('projectid', 'projectname'):
+                found[projectid] = projectname
+
+        for project_id in project_ids:
+            PROJECT_NAMES.put(project_id, found.get(project_id, None))
+
+    def preload(self, user_ids=(), project_ids=()):
+        missing_users = self._missing(USER_NAMES, user_ids)
+        if missing_users:
+            self._load_users(missing_users)
+
+        missing_projects = self._missing(PROJECT_NAMES, project_ids)
+        if missing_projects:
+            self._load_projects(missing_projects)
+
+    def user_name(self, user_id):
+        if not user_id:
+            return None
+        found, name = USER_NAMES.get(user_id)
+        if not found:
+            self._load_users(set([user_id]))
+            name = USER_NAMES.get(user_id)[1]
+        return name
+
+    def project_name(self, project_id):
+        if not project_id:
+            return None
+        found, name = PROJECT_NAMES.get(project_id)
+        if not found:
+            self._load_projects(set([project_id]))
+            name = PROJECT_NAMES.get(project_id)[1]
+        return name
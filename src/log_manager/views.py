@@ -22,6 +22,9 @@ import datetime
 
 from django.core.urlresolvers import reverse
 from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.views.generic import View
+from django.db.models import Q
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from horizon import exceptions
@@ -30,11 +33,16 @@ from horizon import forms
 from horizon import messages
 from horizon import views
 from horizon.utils import memoized
+from horizon.utils.functions import get_page_size
 from openstack_dashboard import api
 
 from openstack_auth_shib.models import Log
+from openstack_auth_shib.logexport import export_logs
+from openstack_auth_shib.logexport import EXPORT_FORMATS
+from openstack_auth_shib.logsearch import get_search_backend
 from openstack_auth_shib.notifications import LOG_TYPE_EMAIL
 from .tables import MainTable
+from .utils import NameResolver
 
 
 LOG = logging.getLogger(__name__)
@@ -116,37 +124,49 @@ class DateRange(object):
         return self.form
 
 
-def _get_project_name(request, project_id):
-    project_name = None
-    if project_id:
-        try:
-            project = api.keystone.tenant_get(request, project_id)
-            project_name = project.name
-        except Exception as e:
-            msg = ('Failed to get project %(project_id)s: %(reason)s' %
-                   {'project_id': project_id, 'reason': e})
-            LOG.error(msg)
-    return project_name
-
-
-def _get_user_name(request, user_id):
-    user_name = None
-    if user_id:
-        try:
-            user = api.keystone.user_get(request, user_id)
-            user_name = user.name
-        except Exception as e:
-            msg = ('Failed to get user %(user_id)s: %(reason)s' %
-                   {'user_id': user_id, 'reason': e})
-            LOG.error(msg)
-    return user_name
-
-
 class MainView(tables.DataTableView):
     table_class = MainTable
     template_name = 'idmanager/log_manager/log_manager.html'
     page_title = _("Logs")
 
+    def has_prev_data(self, table):
+        return getattr(self, '_prev', False)
+
+    def has_more_data(self, table):
+        return getattr(self, '_more', False)
+
+    def _get_cursor(self, marker):
+        # the cursor is the pair (timestamp, id) of the marker row
+        try:
+            return Log.objects.filter(id=int(marker)).values_list('timestamp', 'id')[0]
+        except Exception:
+            return None
+
+    def _get_page(self, queryset):
+        page_size = get_page_size(self.request)
+        marker = self.request.GET.get(MainTable._meta.pagination_param, None)
+        prev_marker = self.request.GET.get(MainTable._meta.prev_pagination_param, None)
+
+        cursor = self._get_cursor(prev_marker) if prev_marker else None
+        if cursor:
+            ts, log_id = cursor
+            queryset = queryset.filter(Q(timestamp__lt=ts) | Q(timestamp=ts, id__lt=log_id))
+            values = list(queryset.order_by('-timestamp', '-id')[:page_size + 1])
+            self._prev = len(values) > page_size
+            self._more = True
+            values = values[:page_size]
+            values.reverse()
+            return values
+
+        cursor = self._get_cursor(marker) if marker else None
+        if cursor:
+            ts, log_id = cursor
+            queryset = queryset.filter(Q(timestamp__gt=ts) | Q(timestamp=ts, id__gt=log_id))
+        values = list(queryset.order_by('timestamp', 'id')[:page_size + 1])
+        self._prev = cursor is not None
+        self._more = len(values) > page_size
+        return values[:page_size]
+
     def get_data(self):
         logs = []
 
@@ -156,16 +176,30 @@ class MainView(tables.DataTableView):
         filters = self.get_filters()
         filters['timestamp__gte'] = start
         filters['timestamp__lte'] = end
+        fulltext = filters.pop('fulltext', None)
+
+        queryset = Log.objects.filter(**filters)
+        if fulltext:
+            queryset = get_search_backend().filter(queryset, fulltext)
+
+        values = self._get_page(queryset)
+
+        resolver = NameResolver(self.request)
+        resolver.preload(
+            set(x.user_id for x in values if not x.user_name) |
+            set(x.dst_user_id for x in values),
+            set(x.project_id for x in values if not x.project_name) |
+            set(x.dst_project_id for x in values)
+        )
 
-        values = Log.objects.filter(**filters)
         for log in values:
             if not log.user_name:
-                log.user_name = self.get_user_name(getattr(log, "user_id"))
+                log.user_name = resolver.user_name(getattr(log, "user_id"))
             if not log.project_name:
-                log.project_name = self.get_project_name(getattr(log, "project_id"))
+                log.project_name = resolver.project_name(getattr(log, "project_id"))
 
-            log.dst_user_name = self.get_user_name(getattr(log, "dst_user_id"))
-            log.dst_project_name = self.get_project_name(getattr(log, "dst_project_id"))
+            log.dst_user_name = resolver.user_name(getattr(log, "dst_user_id"))
+            log.dst_project_name = resolver.project_name(getattr(log, "dst_project_id"))
 
             logs.append(log)
 
@@ -177,14 +211,6 @@ class MainView(tables.DataTableView):
 
         return context
 
-    @memoized.memoized_method
-    def get_project_name(self, project_id):
-        return _get_project_name(self.request, project_id)
-
-    @memoized.memoized_method
-    def get_user_name(self, user_id):
-        return _get_user_name(self.request, user_id)
-
 
 class DetailView(views.HorizonTemplateView):
     template_name = 'idmanager/log_manager/detail.html'
@@ -207,20 +233,13 @@ class DetailView(views.HorizonTemplateView):
 
         context["dst_user_id"] = getattr(log, "dst_user_id", _("None"))
         context["dst_project_id"] = getattr(log, "dst_project_id", _("None"))
-        context["dst_user_name"] = self.get_user_name(getattr(log, "dst_user_id"))
-        context["dst_project_name"] = self.get_project_name(getattr(log, "dst_project_id"))
+        resolver = NameResolver(self.request)
+        context["dst_user_name"] = resolver.user_name(getattr(log, "dst_user_id"))
+        context["dst_project_name"] = resolver.project_name(getattr(log, "dst_project_id"))
 
         context["url"] = self.get_redirect_url()
         return context
 
-    @memoized.memoized_method
-    def get_project_name(self, project_id):
-        return _get_project_name(self.request, project_id)
-
-    @memoized.memoized_method
-    def get_user_name(self, user_id):
-        return _get_user_name(self.request, user_id)
-
     @memoized.memoized_method
     def get_data(self):
         try:
@@ -235,3 +254,28 @@ class DetailView(views.HorizonTemplateView):
 
     def get_redirect_url(self):
         return reverse('horizon:idmanager:log_manager:index')
+
+
+class ExportView(View):
+
+    def get(self, request, *args, **kwargs):
+        fmt = request.GET.get('format', 'csv')
+        if not fmt in EXPORT_FORMATS:
+            fmt = 'csv'
+
+        date_range = DateRange(request)
+        start, end = date_range.get_date_range()
+
+        filters = {
+            'timestamp__gte' : start,
+            'timestamp__lte' : end
+        }
+        chunk_size = getattr(settings, 'LOG_MANAGER_EXPORT_CHUNK', 1000)
+
+        response = StreamingHttpResponse(
+            export_logs(Log.objects.filter(**filters), fmt, chunk_size),
+            content_type=EXPORT_FORMATS[fmt]
+        )
+        response['Content-Disposition'] = 'attachment; filename="logs-%s-%s.%s"' % \
+            (start.date().isoformat(), end.date().isoformat(), fmt)
+        return response
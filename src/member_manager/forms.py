@@ -35,6 +35,7 @@ from openstack_auth_shib.models import PrjRole
 from openstack_auth_shib.models import PSTATUS_RENEW_MEMB
 from openstack_auth_shib.notifications import notifyUser
 from openstack_auth_shib.notifications import notifyAdmin
+from openstack_auth_shib.notifications import NotificationBatch
 from openstack_auth_shib.notifications import USER_RENEWED_TYPE
 
 from openstack_auth_shib.utils import set_last_exp
@@ -111,9 +112,10 @@ class ModifyExpForm(forms.SelfHandlingForm):
                 }
 
                 try:
-                    notifyUser(request=request, rcpt=user_mail, action=USER_RENEWED_TYPE,
-                               context=noti_params, dst_user_id=data['userid'])
-                    notifyAdmin(request=request, action=USER_RENEWED_TYPE, context=noti_params)
+                    with NotificationBatch():
+                        notifyUser(request=request, rcpt=user_mail, action=USER_RENEWED_TYPE,
+                                   context=noti_params, dst_user_id=data['userid'])
+                        notifyAdmin(request=request, action=USER_RENEWED_TYPE, context=noti_params)
                 except:
                     LOG.error("Cannot notify %s" % user_name, exc_info=True)
 
@@ -37,6 +37,8 @@ from openstack_auth_shib.models import PrjRequest
 
 from openstack_auth_shib.notifications import notifyUser
 from openstack_auth_shib.notifications import notifyAdmin
+from openstack_auth_shib.notifications import NotificationBatch
+from openstack_auth_shib.notifications import DeferredNotifications
 from openstack_auth_shib.notifications import MEMBER_REMOVED
 from openstack_auth_shib.notifications import MEMBER_REMOVED_ADM
 from openstack_auth_shib.notifications import CHANGED_MEMBER_ROLE
@@ -105,9 +107,10 @@ class DeleteMemberAction(tables.DeleteAction):
                 'admin_address' : admin_email,
                 'project' : request.user.tenant_name
             }
-            notifyUser(request=request, rcpt=member_email, action=MEMBER_REMOVED, context=noti_params,
-                       dst_user_id=obj_id)
-            notifyAdmin(request=request, action=MEMBER_REMOVED_ADM, context=noti_params)
+            with NotificationBatch():
+                notifyUser(request=request, rcpt=member_email, action=MEMBER_REMOVED, context=noti_params,
+                           dst_user_id=obj_id)
+                notifyAdmin(request=request, action=MEMBER_REMOVED_ADM, context=noti_params)
 
             
         except:
@@ -163,14 +166,16 @@ class ToggleRoleAction(tables.Action):
 
                     roles_obj.revoke(t_role_id, **arg_dict)
 
-                noti_params = {
-                    'admin_address' : admin_email,
-                    'project' : request.user.tenant_name,
-                    's_role' : _('Project manager'),
-                    'd_role' : _('Project user')
-                }
-                notifyUser(request=request, rcpt=member_email, action=CHANGED_MEMBER_ROLE, context=noti_params,
-                           dst_project_id=request.user.project_id, dst_user_id=obj_id)
+                    noti_params = {
+                        'admin_address' : admin_email,
+                        'project' : request.user.tenant_name,
+                        's_role' : _('Project manager'),
+                        'd_role' : _('Project user')
+                    }
+                    with DeferredNotifications():
+                        notifyUser(request=request, rcpt=member_email, action=CHANGED_MEMBER_ROLE,
+                                   context=noti_params, dst_project_id=request.user.project_id,
+                                   dst_user_id=obj_id)
             
             else:
 
@@ -184,14 +189,16 @@ class ToggleRoleAction(tables.Action):
 
                     roles_obj.grant(t_role_id, **arg_dict)
 
-                noti_params = {
-                    'admin_address' : admin_email,
-                    'project' : request.user.tenant_name,
-                    's_role' : _('Project user'),
-                    'd_role' : _('Project manager')
-                }
-                notifyUser(request=request, rcpt=member_email, action=CHANGED_MEMBER_ROLE, context=noti_params,
-                           dst_project_id=request.user.project_id, dst_user_id=obj_id)
+                    noti_params = {
+                        'admin_address' : admin_email,
+                        'project' : request.user.tenant_name,
+                        's_role' : _('Project user'),
+                        'd_role' : _('Project manager')
+                    }
+                    with DeferredNotifications():
+                        notifyUser(request=request, rcpt=member_email, action=CHANGED_MEMBER_ROLE,
+                                   context=noti_params, dst_project_id=request.user.project_id,
+                                   dst_user_id=obj_id)
 
         except:
             LOG.error("Toggle role error", exc_info=True)
@@ -76,11 +76,10 @@ class IndexView(tables.DataTableView):
                 rp_item[2] = number_of_admins
         
             result = list()
-            q_args = {
-                'registration__userid__in' : member_id_dict,
-                'project__projectid' : self.request.user.tenant_id
-            }
-            for expir in Expiration.objects.filter(**q_args):
+            exp_list = Expiration.objects.for_users(member_id_dict.keys()) \
+                                         .for_projects([ self.request.user.tenant_id ]) \
+                                         .select_related('registration')
+            for expir in exp_list:
                 reg = expir.registration
                 result.append(MemberItem(reg, member_id_dict[reg.userid], expir.expdate))
             return result
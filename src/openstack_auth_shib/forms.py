@@ -43,6 +43,7 @@ from .models import EMAIL_LEN
 from .models import PSTATUS_REG
 from .models import PSTATUS_PENDING
 from .notifications import notifyAdmin, REGISTR_AVAIL_TYPE
+from .notifications import DeferredNotifications
 from .utils import get_ostack_attributes
 from .utils import check_projectname
 
@@ -498,12 +499,13 @@ class RegistrForm(forms.SelfHandlingForm):
                     reqPrj = PrjRequest(**reqArgs)
                     reqPrj.save()
 
-            noti_params = {
-                'username': data['username'],
-                'projects': list(p[0] for p in prjlist),
-                'project_creation': (prj_action == 'newprj'),
-            }
-            notifyAdmin(request=self.request, action=REGISTR_AVAIL_TYPE, context=noti_params)
+                noti_params = {
+                    'username': data['username'],
+                    'projects': list(p[0] for p in prjlist),
+                    'project_creation': (prj_action == 'newprj'),
+                }
+                with DeferredNotifications():
+                    notifyAdmin(request=self.request, action=REGISTR_AVAIL_TYPE, context=noti_params)
 
             # Don't user reverse_lazy
             # It is necessary to get out of the protected area
@@ -0,0 +1,115 @@
+#  Copyright (c) 2014 INFN - "Istituto Nazionale di Fisica Nucleare" - Italy
+#  All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+import csv
+import json
+
+from .models import Log
+from .models import LogExtra
+
+EXPORT_FIELDS = [
+    'id',
+    'timestamp',
+    'log_type',
+    'action',
+    'project_id',
+    'user_id',
+    'project_name',
+    'user_name',
+    'dst_project_id',
+    'dst_user_id',
+    'message'
+]
+
+EXPORT_FORMATS = {
+    'csv' : 'text/csv',
+    'jsonl' : 'application/x-ndjson'
+}
+
+DEFAULT_CHUNK = 1000
+
+#
+# Pseudo file used for getting back the lines produced by the csv writer
+#
+class _LineBuffer:
+    def write(self, value):
+        return value
+
+def get_extra_table(log_ids):
+    result = dict()
+    for l_extra in LogExtra.objects.filter(log_id__in=log_ids):
+        if not l_extra.log_id in result:
+            result[l_extra.log_id] = dict()
+        result[l_extra.log_id][l_extra.key] = l_extra.value
+    return result
+
+def iter_log_chunks(queryset, chunk_size=DEFAULT_CHUNK):
+    #
+    # Rows are read in chunks ordered by id (keyset), the extras of each
+    # chunk are loaded with a single query; memory usage is bounded by chunk_size
+    #
+    last_id = None
+    while True:
+        chunk_qs = queryset.order_by('id')
+        if last_id is not None:
+            chunk_qs = chunk_qs.filter(id__gt=last_id)
+        chunk = list(chunk_qs[:chunk_size])
+        if len(chunk) == 0:
+            return
+
+        extra_table = get_extra_table([ x.id for x in chunk ])
+
+        for log in chunk:
+            yield (log, extra_table.get(log.id, {}))
+
+        last_id = chunk[-1].id
+
+def log_to_dict(log, extra):
+    result = dict()
+    for fname in EXPORT_FIELDS:
+        result[fname] = getattr(log, fname)
+    result['timestamp'] = log.timestamp.isoformat()
+    result['extra'] = extra
+    return result
+
+def _encode(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def export_logs(queryset=None, fmt='csv', chunk_size=DEFAULT_CHUNK):
+
+    if queryset is None:
+        queryset = Log.objects.all()
+
+    if fmt == 'jsonl':
+        for log, extra in iter_log_chunks(queryset, chunk_size):
+            yield json.dumps(log_to_dict(log, extra)) + '\n'
+        return
+
+    if fmt != 'csv':
+        raise ValueError("Unsupported format %s" % fmt)
+
+    writer = csv.writer(_LineBuffer())
+    yield writer.writerow(EXPORT_FIELDS + [ 'extra' ])
+
+    for log, extra in iter_log_chunks(queryset, chunk_size):
+        l_dict = log_to_dict(log, extra)
+        row = [ _encode(l_dict[x]) for x in EXPORT_FIELDS ]
+        row.append(json.dumps(extra) if extra else '')
+        yield writer.writerow(row)
+
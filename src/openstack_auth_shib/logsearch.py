@@ -0,0 +1,179 @@
+#  Copyright (c) 2014 INFN - "Istituto Nazionale di Fisica Nucleare" - Italy
+#  All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+import logging
+import re
+
+from django.conf import settings
+from django.db import connections
+from django.db import router
+from django.db import OperationalError
+
+from .models import Log
+
+LOG = logging.getLogger(__name__)
+
+TERM_REGEX = re.compile(r'\w+', re.UNICODE)
+
+MAX_IDS_PER_QUERY = 500
+
+def get_search_terms(text):
+    return TERM_REGEX.findall(text)
+
+#
+# Default backend: sequential scan with LIKE '%...%'
+#
+class LogSearchBackend():
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self.log_table = Log._meta.db_table
+
+    def setup(self):
+        pass
+
+    def update_index(self, batch_size=1000):
+        return 0
+
+    def remove(self, log_ids):
+        pass
+
+    def filter(self, queryset, text):
+        return queryset.filter(message__icontains=text)
+
+    def _execute(self, sql, params=None):
+        with connections[self.db_name].cursor() as cursor:
+            cursor.execute(sql, params)
+
+#
+# InnoDB FULLTEXT index, the index is maintained by the database
+#
+class MySQLSearchBackend(LogSearchBackend):
+
+    def setup(self):
+        self._execute("CREATE FULLTEXT INDEX %s_message_ft ON %s (message)"
+                      % (self.log_table, self.log_table))
+
+    def filter(self, queryset, text):
+        terms = get_search_terms(text)
+        if len(terms) == 0:
+            return queryset
+        return queryset.extra(
+            where=[ "MATCH(message) AGAINST (%s IN BOOLEAN MODE)" ],
+            params=[ " ".join("+" + x for x in terms) ]
+        )
+
+#
+# GIN index on the tsvector expression, the index is maintained by the database
+#
+class PostgreSQLSearchBackend(LogSearchBackend):
+
+    def setup(self):
+        self._execute("CREATE INDEX %s_message_ts ON %s USING GIN (to_tsvector('simple', message))"
+                      % (self.log_table, self.log_table))
+
+    def filter(self, queryset, text):
+        terms = get_search_terms(text)
+        if len(terms) == 0:
+            return queryset
+        return queryset.extra(
+            where=[ "to_tsvector('simple', message) @@ plainto_tsquery('simple', %s)" ],
+            params=[ " ".join(terms) ]
+        )
+
+#
+# FTS5 virtual table keyed by the id of the log, the index is
+# updated incrementally by update_index() starting from the highest indexed id
+#
+class SQLiteSearchBackend(LogSearchBackend):
+
+    def __init__(self, db_name):
+        LogSearchBackend.__init__(self, db_name)
+        self.fts_table = self.log_table + '_fts'
+
+    def setup(self):
+        self._execute("CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(message)"
+                      % self.fts_table)
+
+    def update_index(self, batch_size=1000):
+        n_indexed = 0
+        with connections[self.db_name].cursor() as cursor:
+            while True:
+                cursor.execute("SELECT COALESCE(MAX(rowid), 0) FROM %s" % self.fts_table)
+                last_id = cursor.fetchone()[0]
+                cursor.execute("INSERT INTO %s (rowid, message) SELECT id, message FROM %s "
+                               "WHERE id > %%s ORDER BY id LIMIT %%s"
+                               % (self.fts_table, self.log_table), [ last_id, batch_size ])
+                if cursor.rowcount < batch_size:
+                    n_indexed += max(cursor.rowcount, 0)
+                    break
+                n_indexed += cursor.rowcount
+        return n_indexed
+
+    #
+    # The ids are removed in chunks, old SQLite builds accept at most
+    # 999 parameters per statement
+    #
+    def remove(self, log_ids):
+        log_ids = list(log_ids)
+        if len(log_ids) == 0:
+            return
+
+        with connections[self.db_name].cursor() as cursor:
+            table_names = connections[self.db_name].introspection.table_names(cursor)
+        if not self.fts_table in table_names:
+            LOG.warning("Missing full text index %s, run indexlogs --setup" % self.fts_table)
+            return
+
+        try:
+            for idx in range(0, len(log_ids), MAX_IDS_PER_QUERY):
+                id_chunk = log_ids[idx:idx + MAX_IDS_PER_QUERY]
+                self._execute("DELETE FROM %s WHERE rowid IN (%s)"
+                              % (self.fts_table, ",".join([ "%s" ] * len(id_chunk))), id_chunk)
+        except OperationalError:
+            #
+            # The index has not been created with "indexlogs --setup"
+            #
+            LOG.error("Cannot remove logs from the full text index", exc_info=True)
+
+    def filter(self, queryset, text):
+        terms = get_search_terms(text)
+        if len(terms) == 0:
+            return queryset
+        return queryset.extra(
+            where=[ "id IN (SELECT rowid FROM %s WHERE %s MATCH %%s)"
+                    % (self.fts_table, self.fts_table) ],
+            params=[ " ".join('"%s"' % x for x in terms) ]
+        )
+
+SEARCH_BACKENDS = {
+    'mysql' : MySQLSearchBackend,
+    'postgresql' : PostgreSQLSearchBackend,
+    'sqlite' : SQLiteSearchBackend
+}
+
+#
+# The index-backed search is used only if LOG_MANAGER_FULLTEXT_ENABLED is set,
+# the index must be created in advance with "indexlogs --setup"
+#
+def get_search_backend(force=False):
+    db_name = router.db_for_read(Log)
+    if force or getattr(settings, 'LOG_MANAGER_FULLTEXT_ENABLED', False):
+        vendor = connections[db_name].vendor
+        if vendor in SEARCH_BACKENDS:
+            return SEARCH_BACKENDS[vendor](db_name)
+        LOG.warning("Full text search not supported for %s" % vendor)
+    return LogSearchBackend(db_name)
+
@@ -13,7 +13,15 @@
 #  License for the specific language governing permissions and limitations
 #  under the License. 
 
+from django import VERSION as django_version
+from django.core.cache import cache
+from django.db import connections
 from django.db import models
+from django.db import router
+from django.db import transaction
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from django.utils import timezone
 
 # Used bit mask for project status
@@ -52,6 +60,34 @@ RSTATUS_REMINDER = 1
 #
 RSTATUS_REMINDACK = 2
 
+
+#
+# Outgoing mail is waiting for delivery (or for a retry)
+#
+MSTATUS_QUEUED = 0
+#
+# Outgoing mail has been delivered to the SMTP server
+#
+MSTATUS_SENT = 1
+#
+# Outgoing mail has been discarded after the max number of retries
+#
+MSTATUS_FAILED = 2
+
+
+#
+# Cron command is running (or it has been killed)
+#
+CSTATUS_RUNNING = 0
+#
+# Cron command completed
+#
+CSTATUS_DONE = 1
+#
+# Cron command aborted
+#
+CSTATUS_FAILED = 2
+
 OS_ID_LEN = 64
 OS_LNAME_LEN = 255
 OS_SNAME_LEN = 64
@@ -59,6 +95,36 @@ EXT_ACCT_LEN = OS_LNAME_LEN
 EMAIL_LEN = 255
 PWD_LEN = 64
 
+#
+# Indexes of the hot queries as (name, fields): Meta.indexes is available
+# since Django 1.11, on the older versions and on the tables of an existing
+# installation the indexes are created by updateindexes
+#
+PRJROLE_INDEXES = (
+    ('aai_prjrole_prj_reg_idx', ('project', 'registration')),
+)
+
+PRJREQ_INDEXES = (
+    ('aai_prjreq_prj_flow_idx', ('project', 'flowstatus')),
+    ('aai_prjreq_reg_prj_idx', ('registration', 'project')),
+)
+
+#
+# The log panel filters by date range and one column,
+# the pages are sorted by (timestamp, id)
+#
+LOG_INDEXES = (
+    ('aai_log_ts_id_idx', ('timestamp', 'id')),
+    ('aai_log_action_ts_idx', ('action', 'timestamp')),
+    ('aai_log_prjid_ts_idx', ('project_id', 'timestamp')),
+    ('aai_log_userid_ts_idx', ('user_id', 'timestamp')),
+    ('aai_log_prjname_ts_idx', ('project_name', 'timestamp')),
+    ('aai_log_username_ts_idx', ('user_name', 'timestamp')),
+)
+
+def get_indexes(index_specs):
+    return [ models.Index(fields=list(fields), name=name) for name, fields in index_specs ]
+
 # Persistent data
 class Registration(models.Model):
     regid = models.AutoField(primary_key=True)
@@ -93,6 +159,21 @@ class Registration(models.Model):
         null=True
     )
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Registration, cls).from_db(db, field_names, values)
+        instance._stored_userid = instance.__dict__.get('userid', None)
+        return instance
+
+    def save(self, *args, **kwargs):
+        super(Registration, self).save(*args, **kwargs)
+        if self.userid and self.userid <> getattr(self, '_stored_userid', None):
+            for model in (Expiration, PrjRequest, PrjRole):
+                model.objects.filter(registration=self).update(userid=self.userid)
+            invalidate_prjman_cache(PrjRole.objects.filter(registration=self)
+                                                   .values_list('projectid', flat=True))
+        self._stored_userid = self.userid
+
 class Project(models.Model):
     #
     # project name as registered in keystone
@@ -116,6 +197,20 @@ class Project(models.Model):
     #
     status = models.IntegerField()
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Project, cls).from_db(db, field_names, values)
+        instance._stored_projectid = instance.__dict__.get('projectid', None)
+        return instance
+
+    def save(self, *args, **kwargs):
+        super(Project, self).save(*args, **kwargs)
+        if self.projectid and self.projectid <> getattr(self, '_stored_projectid', None):
+            for model in (Expiration, PrjRequest, PrjRole):
+                model.objects.filter(project=self).update(projectid=self.projectid)
+            invalidate_prjman_cache([ self.projectid ])
+        self._stored_projectid = self.projectid
+
 class UserMapping(models.Model):
     #
     # the id provided by the SSO authority
@@ -129,21 +224,70 @@ class UserMapping(models.Model):
                                     db_index=False,
                                     on_delete=models.CASCADE)
 
-class Expiration(models.Model):
+#
+# Base class for the tables referring to both a registration and a project,
+# userid and projectid are copies of Registration.userid and Project.projectid,
+# used for filtering without joins.
+# They are set by save() and updated by Registration.save() and Project.save(),
+# bulk operations must set them explicitly.
+# The rows of an existing installation are filled in by "backfillids",
+# which must be run on upgrade (see README.md)
+#
+class RegProjectQuerySet(models.QuerySet):
+
+    def for_users(self, user_ids):
+        return self.filter(userid__in=list(user_ids))
+
+    def for_projects(self, project_ids):
+        return self.filter(projectid__in=list(project_ids))
+
+class RegProjectRelation(models.Model):
+    objects = RegProjectQuerySet.as_manager()
+
+    userid = models.CharField(
+        max_length=OS_ID_LEN,
+        db_index=True,
+        null=True
+    )
+    projectid = models.CharField(
+        max_length=OS_ID_LEN,
+        db_index=True,
+        null=True
+    )
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        self.userid = self.registration.userid
+        self.projectid = self.project.projectid
+        super(RegProjectRelation, self).save(*args, **kwargs)
+
+class Expiration(RegProjectRelation):
     registration = models.ForeignKey(Registration, on_delete=models.CASCADE)
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
     expdate = models.DateTimeField(db_index=True)
 
+    class Meta:
+        #
+        # One expiration date per user and project
+        #
+        unique_together = (('registration', 'project'),)
+
 class EMail(models.Model):
     registration = models.ForeignKey(Registration, on_delete=models.CASCADE)
     email = models.EmailField(max_length=EMAIL_LEN)
 
-class PrjRole(models.Model):
+class PrjRole(RegProjectRelation):
     registration = models.ForeignKey(Registration, on_delete=models.CASCADE)
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
     roleid = models.CharField(max_length=OS_ID_LEN, null=False)
     status = models.IntegerField(default=0)
 
+    class Meta:
+        if django_version >= (1, 11):
+            indexes = get_indexes(PRJROLE_INDEXES)
+
 #Temporary data
 class RegRequest(models.Model):
     registration = models.ForeignKey(Registration, on_delete=models.CASCADE)
@@ -155,7 +299,7 @@ class RegRequest(models.Model):
     notes = models.TextField()
 
 #Temporary data
-class PrjRequest(models.Model):
+class PrjRequest(RegProjectRelation):
     registration = models.ForeignKey(Registration, on_delete=models.CASCADE)
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
     #
@@ -164,6 +308,10 @@ class PrjRequest(models.Model):
     flowstatus = models.IntegerField(default=PSTATUS_REG)
     notes = models.TextField()
 
+    class Meta:
+        if django_version >= (1, 11):
+            indexes = get_indexes(PRJREQ_INDEXES)
+
 
 class LogManager(models.Manager):
     use_in_migrations = True
@@ -191,6 +339,43 @@ class LogManager(models.Manager):
 
         return log
 
+    #
+    # Each record is a dictionary with the same keyword arguments of log_action.
+    # If the database returns the primary keys from a bulk insert the records
+    # are written with two INSERT statements, otherwise the logs are inserted
+    # one by one and the extras with a single statement.
+    #
+    def log_actions_bulk(self, records):
+
+        if len(records) == 0:
+            return list()
+
+        log_list = list()
+        extra_list = list()
+        for rec in records:
+            l_args = dict(rec)
+            extra = l_args.pop('extra', None) or {}
+            log_list.append(self.model(**l_args))
+            extra_list.append(extra)
+
+        db_name = router.db_for_write(self.model)
+        with transaction.atomic(using=db_name):
+            if connections[db_name].features.can_return_ids_from_bulk_insert:
+                log_list = self.model.objects.using(db_name).bulk_create(log_list)
+            else:
+                for log in log_list:
+                    log.save(using=db_name)
+
+            all_extras = list()
+            for log, extra in zip(log_list, extra_list):
+                for k, v in extra.iteritems():
+                    all_extras.append(LogExtra(log=log, key=k, value=v))
+
+            if len(all_extras):
+                LogExtra.objects.using(db_name).bulk_create(all_extras)
+
+        return log_list
+
 
 class Log(models.Model):
     objects = LogManager()
@@ -260,6 +445,10 @@ class Log(models.Model):
         blank=False,
     )
 
+    class Meta:
+        if django_version >= (1, 11):
+            indexes = get_indexes(LOG_INDEXES)
+
 
 class LogExtra(models.Model):
     log = models.ForeignKey(Log, on_delete=models.PROTECT)
@@ -273,3 +462,124 @@ class LogExtra(models.Model):
     value = models.TextField(
         blank=False,
     )
+
+
+#
+# Outbox for the notifications, drained by the sendnotifications command
+#
+class OutMail(models.Model):
+    created = models.DateTimeField(
+        default=timezone.now,
+        editable=False
+    )
+    #
+    # JSON encoded list of recipients, ignored if tomanagers is True
+    #
+    recipients = models.TextField()
+    tomanagers = models.BooleanField(default=False)
+    sender = models.EmailField(max_length=EMAIL_LEN, null=True)
+    subject = models.TextField()
+    body = models.TextField()
+    #
+    # Delivery status, see MSTATUS_* for possible values
+    #
+    status = models.IntegerField(
+        default=MSTATUS_QUEUED,
+        db_index=True
+    )
+    attempts = models.IntegerField(default=0)
+    nextattempt = models.DateTimeField(
+        default=timezone.now,
+        db_index=True
+    )
+    sentdate = models.DateTimeField(null=True)
+    lasterror = models.TextField(null=True)
+
+
+#
+# Execution history of the cron commands
+#
+class CronRun(models.Model):
+    command = models.CharField(
+        max_length=OS_SNAME_LEN,
+        db_index=True
+    )
+    started = models.DateTimeField(default=timezone.now)
+    finished = models.DateTimeField(null=True)
+    #
+    # Status of the execution, see CSTATUS_* for possible values
+    #
+    status = models.IntegerField(default=CSTATUS_RUNNING)
+    processed = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    message = models.TextField(null=True)
+
+#
+# High-water mark of a cron command for a cycle (for example a day):
+# the items with a key lower than or equal to the mark have already
+# been processed in the cycle, except the ones listed in failed (JSON list
+# of keys) and the ones that were not yet eligible at snapshot time
+#
+class CronCheckpoint(models.Model):
+    command = models.CharField(max_length=OS_SNAME_LEN)
+    cycle = models.CharField(max_length=OS_SNAME_LEN)
+    mark = models.TextField()
+    failed = models.TextField(default='[]')
+    snapshot = models.DateTimeField(null=True)
+    run = models.ForeignKey(CronRun, null=True, on_delete=models.SET_NULL)
+    updated = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = (('command', 'cycle'),)
+
+#
+# Lease on a cron command held by a node of the cluster (see aaischeduler),
+# the lease is free if owner is empty or expires is in the past;
+# lastrun is the start time of the last execution in the cluster
+#
+class CronLock(models.Model):
+    command = models.CharField(
+        max_length=OS_SNAME_LEN,
+        unique=True
+    )
+    owner = models.CharField(max_length=OS_LNAME_LEN, default='')
+    expires = models.DateTimeField(default=timezone.now)
+    lastrun = models.DateTimeField(null=True)
+
+
+#
+# Cache of the project administrators (see utils.get_prjman_ids_many)
+# The entries are removed whenever a PrjRole changes, bulk operations
+# (bulk_create, update) must call invalidate_prjman_cache explicitly.
+# The invalidations reach the other processes (web workers, cron commands)
+# only if the default cache is shared (memcached, redis); with LocMemCache
+# the entries of the other processes expire after PRJMAN_CACHE_TTL seconds.
+# The checks guarding a deletion must bypass the cache (use_cache=False)
+#
+PRJMAN_CACHE_PREFIX = 'aai_prjman_'
+
+def get_prjman_cache_key(project_id):
+    return PRJMAN_CACHE_PREFIX + project_id
+
+def invalidate_prjman_cache(project_ids):
+    c_keys = [ get_prjman_cache_key(x) for x in set(project_ids) if x ]
+    if len(c_keys) == 0:
+        return
+
+    cache.delete_many(c_keys)
+    #
+    # Drop the entries loaded by other requests before the transaction is committed
+    #
+    transaction.on_commit(lambda: cache.delete_many(c_keys), using=router.db_for_write(PrjRole))
+
+@receiver(post_save, sender=PrjRole)
+@receiver(post_delete, sender=PrjRole)
+def _prjrole_changed(sender, instance, **kwargs):
+    #
+    # The projectid of the rows not yet processed by backfillids is null
+    #
+    prjid = instance.projectid
+    if not prjid:
+        prjid = Project.objects.filter(projectname=instance.project_id) \
+                               .values_list('projectid', flat=True).first()
+    invalidate_prjman_cache([ prjid ])
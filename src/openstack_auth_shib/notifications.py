@@ -18,22 +18,25 @@ import os, os.path
 import re
 import json
 import threading
+import time
 from types import ListType, TupleType
 from ConfigParser import ConfigParser
 
 from django.conf import settings
 from django.core.mail import send_mail, mail_managers
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
 from django.template import Template as DjangoTemplate
 from django.template import Context as DjangoContext
 from django.utils.translation import ugettext as _
 from horizon import messages as MESSAGES
 
 from .models import Log
+from .models import OutMail
 
 
 LOG = logging.getLogger(__name__)
 
-TEMPLATE_TABLE = dict()
 TEMPLATE_LOCK = threading.Lock()
 TEMPLATE_REGEX = re.compile("notifications_(\w\w).txt$")
 
@@ -71,23 +74,61 @@ LOG_TYPE_EMAIL = '__EMAIL__'
 
 MANAGERS_RCPT = '__MANAGERS__'
 
+BATCH_LOCAL = threading.local()
+
 
 class NotificationTemplate():
 
-    def __init__(self, sbj, body, log_tpl):
+    def __init__(self, name, sbj, body, log_tpl):
+        self.name = name
         self.subject = DjangoTemplate(sbj)
         self.body = DjangoTemplate(body)
         self.log_tpl = DjangoTemplate(log_tpl)
+        self.stats_lock = threading.Lock()
+        self.n_render = 0
+        self.render_time = 0.0
     
     def render(self, ctx_dict):
+        start_time = time.time()
         ctx = DjangoContext(ctx_dict)
-        return (self.subject.render(ctx), self.body.render(ctx), self.log_tpl.render(ctx))
+        result = (self.subject.render(ctx), self.body.render(ctx), self.log_tpl.render(ctx))
+        elapsed = time.time() - start_time
+
+        with self.stats_lock:
+            self.n_render += 1
+            self.render_time += elapsed
+        LOG.debug("Rendered template %s in %.3f ms" % (self.name, elapsed * 1000))
+        return result
+
+#
+# Immutable snapshot of the compiled templates, a new registry is built
+# whenever a notifications_xx.txt changes and replaces the current one
+# with a single assignment, so readers never need the lock.
+# files maps each template file to its (mtime, size),
+# table maps each locale to the dictionary of its templates
+#
+class TemplateRegistry():
+
+    def __init__(self, tpl_dir, files, table, next_check):
+        self.tpl_dir = tpl_dir
+        self.files = files
+        self.table = table
+        self.next_check = next_check
+
+TEMPLATE_REGISTRY = TemplateRegistry(None, dict(), dict(), 0)
 
 
 def _log_notify(rcpt, action, context, locale='en', request=None,
                 user_id=None, project_id=None,
                 user_name=None, project_name=None,
                 dst_user_id=None, dst_project_id=None):
+
+    if _current_deferred():
+        _current_deferred().add((rcpt, action, context, locale, request,
+                                 user_id, project_id, user_name, project_name,
+                                 dst_user_id, dst_project_id))
+        return
+
     def _try_get_from_request_user(request, field):
         value = None
         try:
@@ -129,6 +170,9 @@ def _log_notify(rcpt, action, context, locale='en', request=None,
     }
 
     subject, body, msg = notification_render(action, context, locale)
+    if subject is None:
+        LOG.error("Missing notification template %s for %s" % (action, locale))
+        return
 
     extra = {}
     if getattr(settings, 'LOG_MANAGER_KEEP_NOTIFICATIONS_EMAIL', True):
@@ -140,18 +184,23 @@ def _log_notify(rcpt, action, context, locale='en', request=None,
         extra['email'] = u'To: {to}\nSubject: {subject}\n\n{body}'.format(
             to=to, subject=subject, body=body)
 
-    Log.objects.log_action(
-        log_type=LOG_TYPE_EMAIL,
-        action=action,
-        message=msg,
-        project_id=project_id,
-        user_id=user_id,
-        project_name=project_name,
-        user_name=user_name,
-        dst_project_id=dst_project_id,
-        dst_user_id=dst_user_id,
-        extra=extra,
-    )
+    log_args = {
+        'log_type' : LOG_TYPE_EMAIL,
+        'action' : action,
+        'message' : msg,
+        'project_id' : project_id,
+        'user_id' : user_id,
+        'project_name' : project_name,
+        'user_name' : user_name,
+        'dst_project_id' : dst_project_id,
+        'dst_user_id' : dst_user_id,
+        'extra' : extra
+    }
+
+    if _current_batch():
+        _current_batch().add_log(log_args)
+    else:
+        Log.objects.log_action(**log_args)
 
     if rcpt == MANAGERS_RCPT:
         notifyManagers(subject, body)
@@ -194,53 +243,354 @@ def notifyAdmin(action, context, locale='en', *args, **kwargs):
     _log_notify(MANAGERS_RCPT, action, context, locale, **kwargs)
 
 
+#
+# Groups the notifications of the same type by recipient: a recipient
+# with more than one notification receives a single message rendered
+# with the digest template (<action>_digest), the context of the digest
+# contains the list of the original contexts (items), their number (count)
+# and the values shared by all of them.
+# The digest is disabled by NOTIFICATION_DIGEST_ENABLED = False or if the
+# template file of the locale does not contain the digest template
+#
+DIGEST_SUFFIX = '_digest'
+
+class NotificationDigest():
+
+    def __init__(self, action, locale='en', enabled=None):
+        if enabled is None:
+            enabled = getattr(settings, 'NOTIFICATION_DIGEST_ENABLED', True)
+        self.action = action
+        self.locale = locale
+        self.enabled = enabled
+        self.rcpt_list = list()
+        self.item_table = dict()
+        self.n_failed = 0
+        self.failed_rcpts = list()
+
+    def _add(self, rcpt, context, kwargs):
+        rcpt_key = tuple(rcpt) if type(rcpt) in (ListType, TupleType) else rcpt
+        if not rcpt_key in self.item_table:
+            self.rcpt_list.append((rcpt_key, rcpt))
+            self.item_table[rcpt_key] = list()
+        self.item_table[rcpt_key].append((context, kwargs))
+
+    def addUser(self, rcpt, context, **kwargs):
+        self._add(rcpt, context, kwargs)
+
+    def addProject(self, rcpt, context, **kwargs):
+        kwargs.pop('dst_user_id', None)
+        self._add(rcpt, context, kwargs)
+
+    def addAdmin(self, context, **kwargs):
+        kwargs.pop('dst_project_id', None)
+        kwargs.pop('dst_user_id', None)
+        self._add(MANAGERS_RCPT, context, kwargs)
+
+    def _common_items(self, dict_list):
+        result = dict(dict_list[0])
+        for d_item in dict_list[1:]:
+            for key in result.keys():
+                if not key in d_item or d_item[key] <> result[key]:
+                    del result[key]
+        return result
+
+    def send(self):
+        #
+        # The template files without the digest sections (other locales,
+        # custom themes) fall back to the single notifications
+        #
+        use_digest = self.enabled and has_template(self.action + DIGEST_SUFFIX, self.locale)
+        if self.enabled and not use_digest:
+            LOG.warning("Missing template %s%s for %s, digest disabled"
+                        % (self.action, DIGEST_SUFFIX, self.locale))
+
+        n_sent = 0
+        for rcpt_key, rcpt in self.rcpt_list:
+            item_list = self.item_table[rcpt_key]
+            try:
+                if len(item_list) == 1 or not use_digest:
+                    for context, kwargs in item_list:
+                        _log_notify(rcpt, self.action, context, self.locale, **kwargs)
+                        n_sent += 1
+                    continue
+
+                ctx_list = [ x[0] for x in item_list ]
+                context = self._common_items(ctx_list)
+                context['items'] = ctx_list
+                context['count'] = len(ctx_list)
+                kwargs = self._common_items([ x[1] for x in item_list ])
+                _log_notify(rcpt, self.action + DIGEST_SUFFIX, context, self.locale, **kwargs)
+                n_sent += 1
+            except:
+                self.n_failed += 1
+                self.failed_rcpts.append(rcpt_key)
+                LOG.error("Cannot send %s to %s" % (self.action, str(rcpt)), exc_info=True)
+
+        LOG.debug("Sent %d messages for %s" % (n_sent, self.action))
+        self.rcpt_list = list()
+        self.item_table = dict()
+        return n_sent
+
+
+def has_template(msg_type, locale='en'):
+
+    registry = load_templates()
+    return msg_type in registry.table.get(locale, {})
+
 def notification_render(msg_type, ctx_dict, locale='en'):
 
-    load_templates()
+    registry = load_templates()
     
-    notify_tpl = TEMPLATE_TABLE[locale].get(msg_type, None)
+    notify_tpl = registry.table.get(locale, {}).get(msg_type, None)
     if notify_tpl:
         return notify_tpl.render(ctx_dict)
     return (None, None, None)
 
+def _compile_templates(tpl_filename, locale):
+    result = dict()
+    parser = ConfigParser()
+    with open(tpl_filename) as tpl_file:
+        parser.readfp(tpl_file)
+
+    for sect in parser.sections():
+
+        sbj = parser.get(sect, 'subject') if parser.has_option(sect, 'subject') else "No subject"
+        body = parser.get(sect, 'body') if parser.has_option(sect, 'body') else "No body"
+        log_tpl = parser.get(sect, 'LOG') if parser.has_option(sect, 'LOG') else "No log"
+        result[sect] = NotificationTemplate("%s/%s" % (locale, sect), sbj, body, log_tpl)
+
+    return result
+
 def load_templates():
 
-    TEMPLATE_LOCK.acquire()
-    
-    if len(TEMPLATE_TABLE):
+    registry = TEMPLATE_REGISTRY
+    if time.time() < registry.next_check:
+        return registry
+
+    #
+    # Only one thread checks the template files, the others
+    # go on with the current registry if it is not empty
+    #
+    if not TEMPLATE_LOCK.acquire(len(registry.table) == 0):
+        return registry
+
+    try:
+        return _reload_templates()
+    finally:
         TEMPLATE_LOCK.release()
-        return
 
-    LOG.debug('Filling in the template table')
+def _reload_templates():
+    global TEMPLATE_REGISTRY
+
+    registry = TEMPLATE_REGISTRY
+    now = time.time()
+    if now < registry.next_check:
+        return registry
+
     tpl_dir = getattr(settings, 'NOTIFICATION_TEMPLATE_DIR', '/usr/share/openstack-auth-shib/templates')
-    
+    check_interval = getattr(settings, 'NOTIFICATION_TEMPLATE_CHECK', 60)
+
     try:
+        files = dict()
+        table = dict()
         for tpl_item in os.listdir(tpl_dir):
             res_match = TEMPLATE_REGEX.search(tpl_item)
             if not res_match:
                 continue
-            
+
             locale = res_match.group(1).lower()
-            TEMPLATE_TABLE[locale] = dict()
-        
             tpl_filename = os.path.join(tpl_dir, tpl_item)
-            parser = ConfigParser()
-            parser.readfp(open(tpl_filename))
-        
-            for sect in parser.sections():
-            
-                sbj = parser.get(sect, 'subject') if parser.has_option(sect, 'subject') else "No subject"
-                body = parser.get(sect, 'body') if parser.has_option(sect, 'body') else "No body"
-                log_tpl = parser.get(sect, 'LOG') if parser.has_option(sect, 'LOG') else "No log"
-                TEMPLATE_TABLE[locale][sect] = NotificationTemplate(sbj, body, log_tpl)
-        
+            f_stat = os.stat(tpl_filename)
+            files[tpl_filename] = (f_stat.st_mtime, f_stat.st_size)
+
+            if tpl_dir == registry.tpl_dir and registry.files.get(tpl_filename, None) == files[tpl_filename]:
+                table[locale] = registry.table[locale]
+            else:
+                LOG.debug('Compiling templates from %s' % tpl_filename)
+                table[locale] = _compile_templates(tpl_filename, locale)
+
+        TEMPLATE_REGISTRY = TemplateRegistry(tpl_dir, files, table, now + check_interval)
+
     except:
         #
-        # TODO need cleanup??
+        # The current templates are kept, the files are checked again at the next call
         #
         LOG.error("Cannot load template table", exc_info=True)
+        if len(registry.table):
+            TEMPLATE_REGISTRY = TemplateRegistry(registry.tpl_dir, registry.files,
+                                                 registry.table, now + check_interval)
+
+    return TEMPLATE_REGISTRY
+
+#
+# Returns a list of (template, number of rendering, total time in seconds)
+#
+def get_template_stats():
+    result = list()
+    for tpl_table in TEMPLATE_REGISTRY.table.values():
+        for notify_tpl in tpl_table.values():
+            result.append((notify_tpl.name, notify_tpl.n_render, notify_tpl.render_time))
+    return result
+
+def _queue_enabled():
+    return getattr(settings, 'NOTIFICATION_QUEUE_ENABLED', False)
+
+def enqueue_mail(recipients, subject, body, tomanagers=False):
+    #
+    # The message is stored in the outbox and delivered by the
+    # sendnotifications command; if the current transaction is
+    # rolled back the message is discarded too
+    #
+    OutMail.objects.create(
+        recipients=json.dumps([] if tomanagers else recipients),
+        tomanagers=tomanagers,
+        sender=settings.SERVER_EMAIL,
+        subject=subject,
+        body=body
+    )
+
+#
+# Collects the messages sent by notify() and notifyManagers() within the
+# with-block and delivers them through a single SMTP connection,
+# a new connection is opened every NOTIFICATION_BATCH_SIZE messages.
+# The log records of the notifications are written in bulk as well.
+# Nested blocks are merged into the outermost one.
+#
+class NotificationBatch():
+
+    def __init__(self, max_messages=None):
+        if max_messages is None:
+            max_messages = getattr(settings, 'NOTIFICATION_BATCH_SIZE', 100)
+        self.max_messages = max(max_messages, 1)
+        self.messages = list()
+        self.log_records = list()
+        self.n_failed = 0
+        self.failed_rcpts = set()
+        self.outer = None
+
+    def __enter__(self):
+        self.outer = getattr(BATCH_LOCAL, 'batch', None)
+        if self.outer is None:
+            BATCH_LOCAL.batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.outer is None:
+            BATCH_LOCAL.batch = None
+            self.flush()
+        return False
+
+    def add(self, message):
+        self.messages.append(message)
+        if len(self.messages) >= self.max_messages:
+            self.flush()
+
+    def add_log(self, log_args):
+        self.log_records.append(log_args)
+        if len(self.log_records) >= self.max_messages:
+            self.flush_logs()
+
+    def flush_logs(self):
+        if len(self.log_records) == 0:
+            return
+
+        rec_list = self.log_records
+        self.log_records = list()
+
+        try:
+            Log.objects.log_actions_bulk(rec_list)
+        except:
+            LOG.error("Cannot write %d notification logs" % len(rec_list), exc_info=True)
+
+    def flush(self):
+        self.flush_logs()
+
+        if len(self.messages) == 0:
+            return 0
+
+        msg_list = self.messages
+        self.messages = list()
 
-    TEMPLATE_LOCK.release()
+        #
+        # A single connection for the whole batch, each message is sent
+        # on its own so that a refused recipient does not drop the others
+        #
+        connection = get_connection()
+        try:
+            connection.open()
+        except:
+            LOG.error("Cannot send %d batched notifications" % len(msg_list), exc_info=True)
+            self.n_failed += len(msg_list)
+            for msg in msg_list:
+                self.failed_rcpts.update(msg.to)
+            return len(msg_list)
+
+        n_failed = 0
+        try:
+            for msg in msg_list:
+                try:
+                    connection.send_messages([ msg ])
+                except:
+                    n_failed += 1
+                    self.failed_rcpts.update(msg.to)
+                    LOG.error("Cannot send notification to %s" % str(msg.to), exc_info=True)
+        finally:
+            try:
+                connection.close()
+            except:
+                LOG.debug("Cannot close the mail connection", exc_info=True)
+
+        LOG.debug("Sent %d of %d batched messages" % (len(msg_list) - n_failed, len(msg_list)))
+        self.n_failed += n_failed
+        return n_failed
+
+def _current_batch():
+    return getattr(BATCH_LOCAL, 'batch', None)
+
+#
+# Collects the notifications issued within the with-block, the block must be
+# entered inside transaction.atomic(): when the transaction is committed
+# the notifications are rendered, logged and sent in a NotificationBatch,
+# if the block raises an exception or the transaction is rolled back
+# they are discarded.
+# Nested blocks are merged into the outermost one.
+#
+class DeferredNotifications():
+
+    def __init__(self, using=None):
+        self.using = using
+        self.calls = list()
+        self.outer = None
+
+    def __enter__(self):
+        self.outer = getattr(BATCH_LOCAL, 'deferred', None)
+        if self.outer is None:
+            BATCH_LOCAL.deferred = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.outer is None:
+            BATCH_LOCAL.deferred = None
+            if exc_type is None and len(self.calls):
+                transaction.on_commit(self.dispatch, using=self.using)
+        return False
+
+    def add(self, call_args):
+        self.calls.append(call_args)
+
+    def dispatch(self):
+        call_list = self.calls
+        self.calls = list()
+
+        with NotificationBatch():
+            for call_args in call_list:
+                try:
+                    _log_notify(*call_args)
+                except:
+                    LOG.error("Cannot dispatch notification %s" % call_args[1], exc_info=True)
+
+def _current_deferred():
+    return getattr(BATCH_LOCAL, 'deferred', None)
 
 def notify(recpt, subject, body):
     
@@ -254,8 +604,15 @@ def notify(recpt, subject, body):
         recipients = [ str(recpt) ]
     
     try:
-        send_mail(subject, body, sender, recipients)
-        LOG.debug("Sending %s - %s - to %s" % (subject, body, str(recipients)))
+        if _queue_enabled():
+            enqueue_mail(recipients, subject, body)
+            LOG.debug("Queued %s - %s - to %s" % (subject, body, str(recipients)))
+        elif _current_batch():
+            _current_batch().add(EmailMessage(subject, body, sender, recipients))
+            LOG.debug("Batched %s - %s - to %s" % (subject, body, str(recipients)))
+        else:
+            send_mail(subject, body, sender, recipients)
+            LOG.debug("Sending %s - %s - to %s" % (subject, body, str(recipients)))
     except:
         LOG.error("Cannot send notification", exc_info=True)
 
@@ -263,8 +620,22 @@ def notify(recpt, subject, body):
 def notifyManagers(subject, body):
 
     try:
-        mail_managers(subject, body)
-        LOG.debug("Sending %s - %s - to managers" % (subject, body))
+        if _queue_enabled():
+            enqueue_mail(None, subject, body, tomanagers=True)
+            LOG.debug("Queued %s - %s - to managers" % (subject, body))
+        elif _current_batch():
+            if not settings.MANAGERS:
+                return
+            _current_batch().add(EmailMessage(
+                '%s%s' % (settings.EMAIL_SUBJECT_PREFIX, subject),
+                body,
+                settings.SERVER_EMAIL,
+                [ a[1] for a in settings.MANAGERS ]
+            ))
+            LOG.debug("Batched %s - %s - to managers" % (subject, body))
+        else:
+            mail_managers(subject, body)
+            LOG.debug("Sending %s - %s - to managers" % (subject, body))
     except:
         LOG.error("Cannot send notification", exc_info=True)
 
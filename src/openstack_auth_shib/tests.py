@@ -0,0 +1,185 @@
+#  Copyright (c) 2014 INFN - "Istituto Nazionale di Fisica Nucleare" - Italy
+#  All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License"); you may
+#  not use this file except in compliance with the License. You may obtain
+#  a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#  License for the specific language governing permissions and limitations
+#  under the License.
+
+from unittest import skipUnless
+
+from django.db import connections
+from django.db import router
+from django.db import IntegrityError
+from django.db import transaction
+from django.test import TransactionTestCase
+from django.utils import timezone
+
+from horizon.management.commands.backfillids import Command as BackfillIdsCommand
+from horizon.management.commands.updateindexes import Command as UpdateIndexesCommand
+from horizon.management.commands.updateindexes import INDEXED_MODELS
+from horizon.management.commands.updateindexes import get_columns
+
+from .models import Registration
+from .models import Project
+from .models import Expiration
+from .models import Log
+from .models import PrjRequest
+from .models import PrjRole
+from .models import PSTATUS_PENDING
+
+def is_sqlite(model):
+    return connections[router.db_for_read(model)].vendor == 'sqlite'
+
+#
+# Query plan regression test for the indexes of the hot queries:
+# the indexes are dropped, as in an installation created before they
+# were declared, and restored with updateindexes
+#
+@skipUnless(is_sqlite(Log), "The query plans are checked only on SQLite")
+class QueryPlanTest(TransactionTestCase):
+
+    multi_db = True
+
+    def setUp(self):
+        for model, index_specs in INDEXED_MODELS:
+            conn = connections[router.db_for_write(model)]
+            with conn.schema_editor() as editor:
+                for idx_name, fields in index_specs:
+                    editor.execute(editor.sql_delete_index % {
+                        'name' : editor.quote_name(idx_name),
+                        'table' : editor.quote_name(model._meta.db_table)
+                    })
+                old_uniques = [ x for x in model._meta.unique_together
+                                if get_columns(model, x) in self.get_uniques(model) ]
+                editor.alter_unique_together(model, old_uniques, [])
+
+        self.update_indexes()
+
+    def update_indexes(self):
+        cmd = UpdateIndexesCommand()
+        for model, index_specs in INDEXED_MODELS:
+            cmd._update_model(model, index_specs, False)
+
+    def get_uniques(self, model):
+        conn = connections[router.db_for_read(model)]
+        with conn.cursor() as cursor:
+            constraints = conn.introspection.get_constraints(cursor, model._meta.db_table)
+        return set(tuple(x['columns']) for x in constraints.values() if x['unique'])
+
+    def create_relation(self, model, username, projectname, **kwargs):
+        registration, created = Registration.objects.get_or_create(
+            username=username,
+            defaults={ 'userid' : 'id-' + username }
+        )
+        project, created = Project.objects.get_or_create(
+            projectname=projectname,
+            defaults={ 'projectid' : 'id-' + projectname, 'status' : 0 }
+        )
+        return model.objects.create(registration=registration, project=project, **kwargs)
+
+    def get_plan(self, queryset):
+        sql_stm, params = queryset.query.sql_with_params()
+        conn = connections[queryset.db]
+        with conn.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql_stm, params)
+            return [ str(x[-1]) for x in cursor.fetchall() ]
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = " ".join(self.get_plan(queryset))
+        self.assertIn("INDEX %s" % index_name, plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    def assertNoTableScan(self, queryset):
+        for step in self.get_plan(queryset):
+            if step.startswith("SCAN"):
+                self.assertIn("INDEX", step)
+
+    def test_prjrequest_pending(self):
+        queryset = PrjRequest.objects.filter(project='prj01', flowstatus=PSTATUS_PENDING)
+        self.assertUsesIndex(queryset, 'aai_prjreq_prj_flow_idx')
+
+    def test_prjrequest_membership(self):
+        queryset = PrjRequest.objects.filter(registration=1, project='prj01')
+        self.assertUsesIndex(queryset, 'aai_prjreq_reg_prj_idx')
+
+    def test_prjrole_membership(self):
+        queryset = PrjRole.objects.filter(project='prj01', registration=1)
+        self.assertUsesIndex(queryset, 'aai_prjrole_prj_reg_idx')
+
+    def test_log_page(self):
+        queryset = Log.objects.order_by('-timestamp', '-id')[:20]
+        self.assertUsesIndex(queryset, 'aai_log_ts_id_idx')
+
+    def test_log_action_page(self):
+        queryset = Log.objects.filter(action='approve').order_by('-timestamp', '-id')[:20]
+        self.assertUsesIndex(queryset, 'aai_log_action_ts_idx')
+
+    def test_prjrole_admins(self):
+        queryset = PrjRole.objects.filter(project_id__in=['prj01', 'prj02']) \
+                                  .values_list('project_id', 'registration__userid')
+        self.assertUsesIndex(queryset, 'aai_prjrole_prj_reg_idx')
+        self.assertNoTableScan(queryset)
+
+    def test_prjrole_user_join(self):
+        queryset = PrjRole.objects.filter(registration__userid='uid01', project='prj01')
+        self.assertUsesIndex(queryset, 'aai_prjrole_prj_reg_idx')
+        self.assertNoTableScan(queryset)
+
+    def test_expiration_unique(self):
+        columns = get_columns(Expiration, ('registration', 'project'))
+        self.assertIn(columns, self.get_uniques(Expiration))
+
+        queryset = Expiration.objects.filter(registration=1, project='prj01')
+        self.assertIn("(%s=? AND %s=?)" % columns, " ".join(self.get_plan(queryset)))
+
+        exp_date = timezone.now()
+        self.create_relation(Expiration, 'user01', 'prj01', expdate=exp_date)
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic(using=router.db_for_write(Expiration)):
+                self.create_relation(Expiration, 'user01', 'prj01', expdate=exp_date)
+
+    def test_expiration_duplicates(self):
+        conn = connections[router.db_for_write(Expiration)]
+        with conn.schema_editor() as editor:
+            editor.alter_unique_together(Expiration, Expiration._meta.unique_together, [])
+
+        exp_date = timezone.now()
+        self.create_relation(Expiration, 'user01', 'prj01', expdate=exp_date)
+        self.create_relation(Expiration, 'user01', 'prj01', expdate=exp_date)
+
+        self.update_indexes()
+        columns = get_columns(Expiration, ('registration', 'project'))
+        self.assertNotIn(columns, self.get_uniques(Expiration))
+
+#
+# The denormalized ids of the rows created before the columns were added
+# are filled in by backfillids
+#
+class BackfillIdsTest(TransactionTestCase):
+
+    multi_db = True
+
+    def test_backfill(self):
+        registration = Registration.objects.create(username='user01', userid='uid01')
+        project = Project.objects.create(projectname='prj01', projectid='pid01', status=0)
+        PrjRole.objects.create(registration=registration, project=project, roleid='rid01')
+        orphan = Registration.objects.create(username='user02')
+        PrjRequest.objects.create(registration=orphan, project=project)
+
+        for model in (PrjRole, PrjRequest):
+            model.objects.update(userid=None, projectid=None)
+
+        BackfillIdsCommand().handle()
+
+        self.assertEqual(list(PrjRole.objects.values_list('userid', 'projectid')),
+                         [ ('uid01', 'pid01') ])
+        self.assertEqual(list(PrjRequest.objects.values_list('userid', 'projectid')),
+                         [ (None, 'pid01') ])
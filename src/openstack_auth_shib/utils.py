@@ -17,10 +17,15 @@ import logging
 import re
 import os
 import os.path
+import threading
+import time
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
+from django.core.cache import cache
 from django.db import transaction
+from django.utils import translation
 from django.utils.translation import ugettext as _
 
 from horizon import forms
@@ -39,6 +44,7 @@ from .models import Expiration
 from .models import Project
 from .models import PrjRequest
 from .models import PrjRole
+from .models import get_prjman_cache_key
 from .models import PSTATUS_PENDING
 from .models import PSTATUS_RENEW_MEMB
 
@@ -64,7 +70,6 @@ def get_admin_roleid(request):
 
 
 def get_prjman_ids(request, project_id):
-    result = list()
 
     #kclient = keystone_api.keystoneclient(request, admin=True)
     #tntadm_role_id = get_admin_roleid(request)
@@ -75,9 +80,36 @@ def get_prjman_ids(request, project_id):
     #for item in body['role_assignments']:
     #    result.append(item['user']['id'])
 
-    for item in PrjRole.objects.filter(project__projectid = project_id):
-        if item.registration.userid:
-            result.append(item.registration.userid)
+    return get_prjman_ids_many([ project_id ]).get(project_id, list())
+
+#
+# Returns a dictionary project id -> list of user ids of the project admins,
+# the projects missing from the cache are loaded with a single query.
+# With use_cache=False the cache is not read, the result is always
+# taken from the database
+#
+def get_prjman_ids_many(project_ids, use_cache=True):
+    project_ids = set(x for x in project_ids if x)
+    if len(project_ids) == 0:
+        return dict()
+
+    key_table = dict((get_prjman_cache_key(x), x) for x in project_ids)
+    result = dict()
+    if use_cache:
+        for c_key, c_value in cache.get_many(key_table.keys()).items():
+            result[key_table[c_key]] = c_value
+
+    missing = project_ids - set(result)
+    if len(missing):
+        new_items = dict((x, list()) for x in missing)
+        q_fields = ('projectid', 'userid')
+        for prjid, userid in PrjRole.objects.for_projects(missing).values_list(*q_fields):
+            if prjid in new_items and userid:
+                new_items[prjid].append(userid)
+
+        cache.set_many(dict((get_prjman_cache_key(x), y) for x, y in new_items.items()),
+                       getattr(settings, 'PRJMAN_CACHE_TTL', 300))
+        result.update(new_items)
 
     return result
 
@@ -178,42 +210,171 @@ def check_course_info(info_dict):
 
 CIDR_PATTERN = re.compile("(\d+\.\d+)\.(\d+).0/\d+")
 MAX_AVAIL = getattr(settings, 'MAX_PROPOSED_NETWORKS', 10)
+NET_INDEX_TTL = getattr(settings, 'NETWORK_INDEX_TTL', 60)
 
-def get_avail_networks(request):
+#
+# Allocation bitmap of the /24 networks: for each 2-octets prefix
+# the bit N is set if the network <prefix>.N.0/24 is in use
+#
+class SubnetIndex():
 
-    unit_table = getattr(settings, 'UNIT_TABLE', {})
+    # The first and the last /24 networks of a pool are never proposed
+    FULL_POOL = (1 << 255) | 1
 
-    used_nets = dict()
-    for subdict in neutron_api.subnet_list(request):
-        cidr_match = CIDR_PATTERN.search(subdict['cidr'])
-        if not cidr_match:
-            continue
-        if not cidr_match.group(1) in used_nets:
-            used_nets[cidr_match.group(1)] = list()
-        used_nets[cidr_match.group(1)].append(int(cidr_match.group(2)))
+    def __init__(self, subnet_list=[]):
+        self.pools = dict()
+        for subdict in subnet_list:
+            self.add(subdict['cidr'])
 
-    avail_nets = dict()
+    def add(self, cidr):
+        cidr_match = CIDR_PATTERN.search(cidr)
+        if not cidr_match:
+            return
+        net_pool = cidr_match.group(1)
+        net_idx = int(cidr_match.group(2))
+        if net_idx < 256:
+            self.pools[net_pool] = self.pools.get(net_pool, 0) | (1 << net_idx)
 
-    for unit_id, unit_data in unit_table.items():
+    def is_used(self, net_pool, net_idx):
+        return bool(self.pools.get(net_pool, 0) & (1 << net_idx))
 
+    def next_free(self, net_pool, max_num):
         result = list()
+        bitmap = self.pools.get(net_pool, 0) | SubnetIndex.FULL_POOL
+
+        while len(result) < max_num:
+            # lowest unset bit
+            net_idx = (~bitmap & (bitmap + 1)).bit_length() - 1
+            if net_idx > 254:
+                break
+            result.append("%s.%d.0/24" % (net_pool, net_idx))
+            bitmap |= 1 << net_idx
+
+        return result
+
+NET_INDEX_LOCK = threading.Lock()
+NET_INDEX_CACHE = {
+    'index' : None,
+    'expire' : 0
+}
+
+def get_subnet_index(request):
+    now = time.time()
 
-        used_ipprefs = used_nets.get(unit_data['lan_net_pool'], [])
-        max_avail = max(used_ipprefs) if len(used_ipprefs) > 0 else 0
+    with NET_INDEX_LOCK:
+        if NET_INDEX_CACHE['index'] and NET_INDEX_CACHE['expire'] > now:
+            return NET_INDEX_CACHE['index']
 
-        if max_avail < 255:
-            tmpl = list(set(range(1, max_avail + MAX_AVAIL + 1)) - set(used_ipprefs))
-            tmpl.sort(lambda x,y: x-y)
-            for idx in tmpl:
-                result.append("%s.%d.0/24" % (unit_data['lan_net_pool'], idx))
+    LOG.debug("Building the subnet allocation index")
+    net_index = SubnetIndex(neutron_api.subnet_list(request))
 
-        avail_nets[unit_id] = result
+    with NET_INDEX_LOCK:
+        NET_INDEX_CACHE['index'] = net_index
+        NET_INDEX_CACHE['expire'] = now + NET_INDEX_TTL
+    return net_index
+
+def invalidate_subnet_index():
+    with NET_INDEX_LOCK:
+        NET_INDEX_CACHE['index'] = None
+        NET_INDEX_CACHE['expire'] = 0
+
+def get_avail_networks(request):
+
+    unit_table = get_unit_table()
+    net_index = get_subnet_index(request)
+
+    avail_nets = dict()
+    for unit_id, unit_data in unit_table.items():
+        if 'lan_net_pool' in unit_data:
+            avail_nets[unit_id] = net_index.next_free(unit_data['lan_net_pool'], MAX_AVAIL)
+        else:
+            avail_nets[unit_id] = list()
 
     return avail_nets
 
 
-def setup_new_project(request, project_id, project_name, data):
+#
+# Minimal executor for the provisioning steps of a project:
+# each step is a function returning None on success or the error message
+# to be displayed, steps whose dependencies are satisfied run concurrently.
+# The workers run with the language of the request, so that the error
+# messages are translated as in the calling thread
+#
+class ProvisioningPipeline():
+
+    def __init__(self, workers=None, language=None):
+        if workers is None:
+            workers = getattr(settings, 'PROVISIONING_WORKERS', 4)
+        self.workers = max(workers, 1)
+        self.language = language
+        self.steps = list()
+        self.timings = dict()
+
+    def add_step(self, name, func, depends=()):
+        self.steps.append((name, func, tuple(depends)))
+
+    def _run_step(self, step):
+        name, func, depends = step
+        if self.language:
+            with translation.override(self.language):
+                return self._exec_step(name, func)
+        return self._exec_step(name, func)
+
+    def _exec_step(self, name, func):
+        t_start = time.time()
+        try:
+            err_msg = func()
+        except Exception:
+            LOG.error("Unexpected error in step %s" % name, exc_info=True)
+            err_msg = _("Cannot complete step %s") % name
+        return (name, err_msg, time.time() - t_start)
+
+    def run(self):
+        done = set()
+        failed = set()
+        errors = dict()
+        pending = list(self.steps)
+        pool = ThreadPool(self.workers) if self.workers > 1 else None
+
+        try:
+            while len(pending):
+                ready = list()
+                for step in pending:
+                    if failed.intersection(step[2]):
+                        LOG.error("Skipped step %s: failed dependencies" % step[0])
+                        errors[step[0]] = _("Step %s not executed: a previous step failed") % step[0]
+                        failed.add(step[0])
+                    elif done.issuperset(step[2]):
+                        ready.append(step)
+
+                pending = [ x for x in pending if not x[0] in done | failed and not x in ready ]
+
+                if len(ready) == 0:
+                    if len(pending):
+                        LOG.error("Unresolved dependencies for %s" % str([ x[0] for x in pending ]))
+                    break
+
+                results = pool.map(self._run_step, ready) if pool else map(self._run_step, ready)
+
+                for name, err_msg, elapsed in results:
+                    self.timings[name] = elapsed
+                    LOG.debug("Provisioning step %s completed in %.3f s" % (name, elapsed))
+                    if err_msg:
+                        errors[name] = err_msg
+                        failed.add(name)
+                    else:
+                        done.add(name)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
 
+        #
+        # Errors are reported in the order the steps have been defined
+        #
+        return [ errors[x[0]] for x in self.steps if x[0] in errors ]
+
+def _setup_accounting(request, project_id):
     try:
         acct_table = getattr(settings, 'ACCOUNTING', None)
         if acct_table:
@@ -223,18 +384,10 @@ def setup_new_project(request, project_id, project_name, data):
                 keystone_api.add_tenant_user_role(request, project_id, uid, roleid)
     except:
         LOG.error("Cannot add user for accounting", exc_info=True)
-        messages.error(request, _("Cannot add user for accounting"))
-
-    unit_id = data.get('unit', None)
-
-    cloud_table = get_unit_table()
-    if not unit_id or not unit_id in cloud_table:
-        return
-
-    unit_data = cloud_table[unit_id]
-    prj_cname = re.sub(r'\s+', "-", project_name)
-    flow_step = 0
+        return _("Cannot add user for accounting")
+    return None
 
+def _setup_quota(request, project_id, unit_data):
     try:
 
         cinder_params = dict()
@@ -250,28 +403,101 @@ def setup_new_project(request, project_id, project_name, data):
             cinder_api.tenant_quota_update(request, project_id, **cinder_params)
 
     except:
-            LOG.error("Cannot setup project quota", exc_info=True)
-            messages.error(request, _("Cannot setup project quota"))
+        LOG.error("Cannot setup project quota", exc_info=True)
+        return _("Cannot setup project quota")
+    return None
+
+AGGR_HOST_WORKERS = getattr(settings, 'AGGREGATE_HOST_WORKERS', 8)
+
+#
+# Computes the changes required for the host aggregate of a project,
+# without modifying anything:
+# {
+#   "name" : <aggregate name>,
+#   "availability_zone" : <availability zone>,
+#   "aggregate" : <existing aggregate or None>,
+#   "add_hosts" : <hypervisors to be inserted>,
+#   "metadata" : <metadata to be set>
+# }
+#
+def plan_aggregate(request, project_id, prj_cname, unit_id, unit_data):
+
+    hyper_list = unit_data.get('hypervisors', [])
+    if len(hyper_list) == 0:
+        return None
+
+    agg_prj_cname = "%s-%s" % (unit_data.get('aggregate_prefix', unit_id), prj_cname)
+
+    curr_aggr = None
+    for agg_item in nova_api.aggregate_details_list(request):
+        if agg_item.name == agg_prj_cname:
+            curr_aggr = agg_item
+            break
+
+    curr_hosts = set(curr_aggr.hosts) if curr_aggr else set()
+
+    all_md = { 'filter_tenant_id' : project_id }
+    all_md.update(unit_data.get('metadata', {}))
+
+    return {
+        'name' : agg_prj_cname,
+        'availability_zone' : unit_data.get('availability_zone', 'nova'),
+        'aggregate' : curr_aggr,
+        'add_hosts' : [ x for x in hyper_list if not x in curr_hosts ],
+        'metadata' : all_md
+    }
+
+#
+# Inserts the hypervisors into the aggregate using a bounded pool of workers;
+# returns a dictionary with the error message, or None, for each host
+#
+def add_hosts_to_aggregate(request, aggr_id, host_list, workers=AGGR_HOST_WORKERS):
+
+    def _add_host(h_item):
+        try:
+            nova_api.add_host_to_aggregate(request, aggr_id, h_item)
+            return (h_item, None)
+        except Exception as exc:
+            LOG.error("Cannot insert %s in aggregate %s" % (h_item, aggr_id), exc_info=True)
+            return (h_item, str(exc))
+
+    if len(host_list) == 0:
+        return dict()
+
+    n_workers = max(min(workers, len(host_list)), 1)
+    if n_workers == 1:
+        return dict(map(_add_host, host_list))
 
+    pool = ThreadPool(n_workers)
     try:
+        return dict(pool.map(_add_host, host_list))
+    finally:
+        pool.close()
+        pool.join()
 
-        hyper_list = unit_data.get('hypervisors', [])
-        if len(hyper_list):
-            agg_prj_cname = "%s-%s" % (unit_data.get('aggregate_prefix', unit_id), prj_cname)
-            avail_zone = unit_data.get('availability_zone', 'nova')
+def _setup_aggregate(request, project_id, prj_cname, unit_id, unit_data):
+    flow_step = 0
 
-            new_aggr = nova_api.aggregate_create(request, agg_prj_cname, avail_zone)
-            flow_step += 1
+    try:
+
+        aggr_plan = plan_aggregate(request, project_id, prj_cname, unit_id, unit_data)
+        if aggr_plan:
 
-            for h_item in hyper_list:
-                nova_api.add_host_to_aggregate(request, new_aggr.id, h_item)
+            new_aggr = aggr_plan['aggregate']
+            if not new_aggr:
+                new_aggr = nova_api.aggregate_create(request, aggr_plan['name'],
+                                                     aggr_plan['availability_zone'])
             flow_step += 1
 
-            all_md = { 'filter_tenant_id' : project_id }
-            all_md.update(unit_data.get('metadata', {}))
+            host_report = add_hosts_to_aggregate(request, new_aggr.id, aggr_plan['add_hosts'])
+            failed_hosts = [ h for h, err in host_report.items() if err ]
+            LOG.info("Inserted %d hypervisors in %s" % (len(host_report) - len(failed_hosts),
+                                                        aggr_plan['name']))
+            if len(failed_hosts):
+                raise Exception("Failed hypervisors: %s" % ", ".join(sorted(failed_hosts)))
+            flow_step += 1
 
-            nova_api.aggregate_set_metadata(request, new_aggr.id, all_md)
-            flow_step = 0
+            nova_api.aggregate_set_metadata(request, new_aggr.id, aggr_plan['metadata'])
 
     except:
         if flow_step == 0:
@@ -281,7 +507,11 @@ def setup_new_project(request, project_id, project_name, data):
         else:
             err_msg = _("Cannot set metadata for aggregate")
         LOG.error(err_msg, exc_info=True)
-        messages.error(request, err_msg)
+        return err_msg
+    return None
+
+def _setup_network(request, project_id, prj_cname, unit_id, unit_data, data, net_info):
+    flow_step = 0
 
     try:
 
@@ -300,34 +530,47 @@ def setup_new_project(request, project_id, project_name, data):
             'name' : "sub-%s-lan" % prj_cname
         }
         prj_sub = neutron_api.subnet_create(request, prj_net['id'], **net_args)
-        flow_step += 1
+        invalidate_subnet_index()
+
+        net_info['network_id'] = prj_net['id']
+        net_info['subnet_id'] = prj_sub['id']
+        net_info['gateway_ip'] = subnet_cidr.replace('0/24', '1')
+
+    except:
+        if flow_step == 0:
+            err_msg = _("Cannot create network")
+        else:
+            err_msg = _("Cannot create sub-network")
+        LOG.error(err_msg, exc_info=True)
+        return err_msg
+    return None
+
+def _setup_router(request, project_id, unit_data, net_info):
+    try:
 
         if 'lan_router' in unit_data:
             f_ips = [{
-                "ip_address" : subnet_cidr.replace('0/24', '1'),
-                "subnet_id" : prj_sub['id']
+                "ip_address" : net_info['gateway_ip'],
+                "subnet_id" : net_info['subnet_id']
             }]
-            r_port = neutron_api.port_create(request, prj_net['id'],
+            r_port = neutron_api.port_create(request, net_info['network_id'],
                                              tenant_id=project_id,
                                              project_id=project_id,
                                              fixed_ips=f_ips)
 
             neutron_api.router_add_interface(request, unit_data['lan_router'], 
                                             port_id=r_port['id'])
-        flow_step = 0
 
     except:
-        if flow_step == 0:
-            err_msg = _("Cannot create network")
-        elif flow_step == 1:
-            err_msg = _("Cannot create sub-network")
-        else:
-            err_msg = _("Cannot add interface to router")
+        err_msg = _("Cannot add interface to router")
         LOG.error(err_msg, exc_info=True)
-        messages.error(request, err_msg)
+        return err_msg
+    return None
+
+def _setup_security_group(request, project_id, project_name):
+    flow_step = 0
 
     try:
-        subnet_cidr = data['%s-net' % unit_id]
         def_sec_group = None
         for sg_item in neutron_api.security_group_list(request, tenant_id=project_id):
             if sg_item['name'].lower() == 'default':
@@ -383,8 +626,10 @@ def setup_new_project(request, project_id, project_name, data):
         else:
             err_msg = _("Cannot insert basic rules")
         LOG.error(err_msg, exc_info=True)
-        messages.error(request, err_msg)
+        return err_msg
+    return None
 
+def _setup_tags(request, project_id, unit_id, unit_data, data):
     try:
 
         new_tags = list()
@@ -399,7 +644,50 @@ def setup_new_project(request, project_id, project_name, data):
 
     except:
         LOG.error("Cannot add organization tags", exc_info=True)
-        messages.error(request, _("Cannot add organization tags"))
+        return _("Cannot add organization tags")
+    return None
+
+def setup_new_project(request, project_id, project_name, data):
+
+    unit_id = data.get('unit', None)
+
+    cloud_table = get_unit_table()
+    if not unit_id or not unit_id in cloud_table:
+        err_msg = _setup_accounting(request, project_id)
+        if err_msg:
+            messages.error(request, err_msg)
+        return
+
+    unit_data = cloud_table[unit_id]
+    prj_cname = re.sub(r'\s+', "-", project_name)
+
+    #
+    # The router interface requires the sub-network; the security group is
+    # looked up after the network has been created, since neutron creates
+    # the default group of the project on its first request
+    #
+    net_info = dict()
+    pipeline = ProvisioningPipeline(language=getattr(request, 'LANGUAGE_CODE', None))
+    pipeline.add_step('accounting', lambda: _setup_accounting(request, project_id))
+    pipeline.add_step('quota', lambda: _setup_quota(request, project_id, unit_data))
+    pipeline.add_step('aggregate',
+                      lambda: _setup_aggregate(request, project_id, prj_cname, unit_id, unit_data))
+    pipeline.add_step('network',
+                      lambda: _setup_network(request, project_id, prj_cname, unit_id,
+                                             unit_data, data, net_info))
+    pipeline.add_step('router', lambda: _setup_router(request, project_id, unit_data, net_info),
+                      depends=('network',))
+    pipeline.add_step('security_group',
+                      lambda: _setup_security_group(request, project_id, project_name),
+                      depends=('network',))
+    pipeline.add_step('tags', lambda: _setup_tags(request, project_id, unit_id, unit_data, data))
+
+    t_start = time.time()
+    for err_msg in pipeline.run():
+        messages.error(request, err_msg)
+
+    LOG.info("Project %s set up in %.3f s (%s)" % (project_name, time.time() - t_start,
+             ", ".join("%s: %.3f s" % x for x in sorted(pipeline.timings.items()))))
 
 def add_unit_combos(newprjform):
 
@@ -536,28 +824,95 @@ def dispose_project(request, project_id):
 
 #
 # Workaround for unit_table reloading at runtime
+# The table is parsed only if the file has been modified, otherwise
+# the cached version is returned
 #
+UNIT_TABLE_LOCK = threading.Lock()
+UNIT_TABLE_CACHE = {
+    'key' : None,
+    'table' : None,
+    'hits' : 0,
+    'misses' : 0
+}
+
+UNIT_LIST_KEYS = [ 'hypervisors', 'nameservers' ]
+UNIT_DICT_KEYS = [ 'metadata' ]
+UNIT_STR_KEYS = [ 'name', 'organization', 'availability_zone', 'aggregate_prefix',
+                  'lan_net_pool', 'lan_router' ]
+NET_POOL_REGEX = re.compile(r'^\d+\.\d+$')
+
+def check_unit_table(unit_table):
+    result = dict()
+
+    if not isinstance(unit_table, dict):
+        LOG.error("Unit table is not a dictionary")
+        return result
+
+    for unit_id, unit_data in unit_table.items():
+        try:
+            if not isinstance(unit_data, dict):
+                raise ValueError("definition is not a dictionary")
+            if not 'name' in unit_data:
+                raise ValueError("missing name")
+            for u_key, u_value in unit_data.items():
+                if u_key in UNIT_LIST_KEYS and not isinstance(u_value, (list, tuple)):
+                    raise ValueError("%s is not a list" % u_key)
+                if u_key in UNIT_DICT_KEYS and not isinstance(u_value, dict):
+                    raise ValueError("%s is not a dictionary" % u_key)
+                if u_key in UNIT_STR_KEYS and not isinstance(u_value, basestring):
+                    raise ValueError("%s is not a string" % u_key)
+                if u_key.startswith('quota_') and not isinstance(u_value, (int, long)):
+                    raise ValueError("%s is not an integer" % u_key)
+            if 'lan_net_pool' in unit_data and not NET_POOL_REGEX.search(unit_data['lan_net_pool']):
+                raise ValueError("bad network pool %s" % unit_data['lan_net_pool'])
+            result[unit_id] = unit_data
+        except ValueError as v_err:
+            LOG.error("Discarded unit %s: %s" % (unit_id, str(v_err)))
+
+    return result
+
+def _load_unit_table(unit_filename):
+    try:
+        namespace = dict()
+        with open(unit_filename) as f:
+            exec(compile(f.read(), unit_filename, 'exec'), namespace)
+        return check_unit_table(namespace['UNIT_TABLE'])
+    except Exception:
+        LOG.error("Cannot exec unit table script", exc_info=True)
+
+    return getattr(settings, 'UNIT_TABLE', {})
+
 def get_unit_table():
 
     unit_filename = os.environ.get("CLOUDVENETO_UNITTABLE", 
                                    "/etc/openstack-dashboard/unit_table.py")
     try:
+        f_stat = os.stat(unit_filename)
+    except OSError:
+        return getattr(settings, 'UNIT_TABLE', {})
 
-        if os.path.exists(unit_filename):
-            with open(unit_filename) as f:
-                exec(f.read())
-            return UNIT_TABLE
+    cache_key = (unit_filename, f_stat.st_ino, f_stat.st_mtime, f_stat.st_size)
 
-    except Exception:
-        LOG.error("Cannot exec unit table script", exc_info=True)
+    with UNIT_TABLE_LOCK:
+        if UNIT_TABLE_CACHE['key'] == cache_key:
+            UNIT_TABLE_CACHE['hits'] += 1
+            return UNIT_TABLE_CACHE['table']
 
-    return getattr(settings, 'UNIT_TABLE', {})
+        UNIT_TABLE_CACHE['misses'] += 1
+        LOG.debug("Loading unit table from %s" % unit_filename)
+        UNIT_TABLE_CACHE['table'] = _load_unit_table(unit_filename)
+        UNIT_TABLE_CACHE['key'] = cache_key
+        return UNIT_TABLE_CACHE['table']
+
+def get_unit_table_stats():
+    with UNIT_TABLE_LOCK:
+        return (UNIT_TABLE_CACHE['hits'], UNIT_TABLE_CACHE['misses'])
 
 #
 # Last expiration setup
 #
 def set_last_exp(uid):
-    all_exp = Expiration.objects.filter(registration__userid=uid)
+    all_exp = Expiration.objects.for_users([ uid ])
     if len(all_exp):
         new_exp = max([ x.expdate for x in all_exp ])
     else:
@@ -38,6 +38,7 @@ from django.utils.translation import ugettext as _
 
 from openstack_auth_shib.notifications import notifyProject
 from openstack_auth_shib.notifications import notifyUser
+from openstack_auth_shib.notifications import NotificationBatch
 from openstack_auth_shib.notifications import SUBSCR_WAIT_TYPE
 from openstack_auth_shib.notifications import SUBSCR_ONGOING
 from openstack_auth_shib.notifications import FIRST_REG_OK_TYPE
@@ -519,10 +520,11 @@ class ForcedCheckForm(forms.SelfHandlingForm):
                 'project' : project_name
             }
 
-            notifyProject(request=self.request, rcpt=m_emails, action=SUBSCR_FORCED_OK_TYPE, context=noti_params,
-                          dst_project_id=project_id)
-            notifyUser(request=self.request, rcpt=user_email, action=SUBSCR_OK_TYPE, context=noti_params,
-                       dst_project_id=project_id, dst_user_id=user_id)
+            with NotificationBatch():
+                notifyProject(request=self.request, rcpt=m_emails, action=SUBSCR_FORCED_OK_TYPE, context=noti_params,
+                              dst_project_id=project_id)
+                notifyUser(request=self.request, rcpt=user_email, action=SUBSCR_OK_TYPE, context=noti_params,
+                           dst_project_id=project_id, dst_user_id=user_id)
                 
         except:
             LOG.error("Error forced-checking request", exc_info=True)
@@ -586,10 +588,11 @@ class ForcedRejectForm(forms.SelfHandlingForm):
                 'notes' : data['reason']
             }
 
-            notifyProject(request=self.request, rcpt=m_emails, action=SUBSCR_FORCED_NO_TYPE, context=noti_params,
-                          dst_project_id=project_id)
-            notifyUser(request=self.request, rcpt=user_email, action=SUBSCR_NO_TYPE, context=noti_params,
-                       dst_project_id=project_id, dst_user_id=user_id)
+            with NotificationBatch():
+                notifyProject(request=self.request, rcpt=m_emails, action=SUBSCR_FORCED_NO_TYPE, context=noti_params,
+                              dst_project_id=project_id)
+                notifyUser(request=self.request, rcpt=user_email, action=SUBSCR_NO_TYPE, context=noti_params,
+                           dst_project_id=project_id, dst_user_id=user_id)
                 
         except:
             LOG.error("Error forced-checking request", exc_info=True)
@@ -147,6 +147,8 @@ class OperationTable(tables.DataTable):
     class Meta:
         name = "operation_table"
         verbose_name = _("Pending requests")
+        pagination_param = "regreq_marker"
+        prev_pagination_param = "prev_regreq_marker"
         row_actions = (PreCheckLink,
                        GrantAllLink,
                        RejectLink,
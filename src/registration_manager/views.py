@@ -19,11 +19,11 @@ from datetime import datetime, timedelta
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 from django.core.urlresolvers import reverse_lazy
-from django.db import transaction
 
 from horizon import tables
 from horizon import exceptions
 from horizon import forms
+from horizon.utils.functions import get_page_size
 
 from openstack_auth_shib.models import RegRequest
 from openstack_auth_shib.models import PrjRequest
@@ -58,73 +58,135 @@ class MainView(tables.DataTableView):
     template_name = 'idmanager/registration_manager/reg_manager.html'
     page_title = _("Registrations")
 
-    def get_data(self):
-    
+    def has_prev_data(self, table):
+        return getattr(self, '_prev', False)
+
+    def has_more_data(self, table):
+        return getattr(self, '_more', False)
+
+    def _parse_marker(self, marker):
+        tmpm = REQID_REGEX.search(marker) if marker else None
+        if tmpm:
+            return (int(tmpm.group(1)), tmpm.group(2))
+        return None
+
+    #
+    # The requests are sorted by request id (registration id, project name):
+    # only the registrations of the current page are loaded, the page
+    # boundaries are taken from the markers
+    #
+    def _get_page_regids(self, key, reverse, limit):
+        reg_q = dict()
+        if key:
+            reg_q['registration_id__lte' if reverse else 'registration_id__gte'] = key[0]
+        order = '-registration_id' if reverse else 'registration_id'
+
+        regids = set(RegRequest.objects.filter(flowstatus=RSTATUS_REMINDACK, **reg_q)
+                                       .order_by(order)
+                                       .values_list('registration_id', flat=True)[:limit])
+        regids.update(PrjRequest.objects.filter(**reg_q)
+                                        .order_by(order)
+                                        .values_list('registration_id', flat=True)
+                                        .distinct()[:limit])
+        return sorted(regids, reverse=reverse)[:limit]
+
+    def _load_requests(self, regids):
         reqTable = dict()
-        
-        with transaction.atomic():
-        
-            regid_pending = set()
-            for tmpRegReq in RegRequest.objects.filter(flowstatus=RSTATUS_PENDING):
-                regid_pending.add(tmpRegReq.registration.regid)
-
-            for tmpRegReq in RegRequest.objects.filter(flowstatus=RSTATUS_REMINDACK):
-                req_id = "%d:" % tmpRegReq.registration.regid
-                rData = RegistrData(
-                    registration = tmpRegReq.registration,
-                    requestid = req_id,
-                    code = RegistrData.REMINDER
-                )
-                reqTable[req_id] = rData
-
-            for prjReq in PrjRequest.objects.all():
-
-                rData = RegistrData(registration = prjReq.registration)
-                curr_regid = prjReq.registration.regid
-                
-                if prjReq.flowstatus == PSTATUS_RENEW_MEMB:
 
-                    rData.code = RegistrData.USR_RENEW
-                    rData.project = prjReq.project.projectname
-                    rData.notes = prjReq.notes
-                    requestid = "%d:%s" % (curr_regid, prjReq.project.projectname)
+        regid_pending = set()
+        q_args = {
+            'flowstatus__in' : [ RSTATUS_PENDING, RSTATUS_REMINDACK ],
+            'registration_id__in' : regids
+        }
+        for tmpRegReq in RegRequest.objects.filter(**q_args).select_related('registration'):
 
-                elif prjReq.flowstatus == PSTATUS_RENEW_ADMIN:
+            if tmpRegReq.flowstatus == RSTATUS_PENDING:
+                regid_pending.add(tmpRegReq.registration_id)
+                continue
 
-                    rData.code = RegistrData.PRJADM_RENEW
-                    rData.project = prjReq.project.projectname
-                    rData.notes = prjReq.notes
-                    requestid = "%d:%s" % (curr_regid, prjReq.project.projectname)
+            req_id = "%d:" % tmpRegReq.registration_id
+            rData = RegistrData(
+                registration = tmpRegReq.registration,
+                requestid = req_id,
+                code = RegistrData.REMINDER
+            )
+            reqTable[(tmpRegReq.registration_id, "")] = rData
 
-                elif prjReq.project.projectid:
+        for prjReq in PrjRequest.objects.filter(registration_id__in=regids) \
+                                        .select_related('registration', 'project'):
 
-                    if curr_regid in regid_pending:
-                        rData.code = RegistrData.NEW_USR_EX_PRJ
-                        requestid = "%d:" % curr_regid
-                    else:
-                        rData.code = RegistrData.EX_USR_EX_PRJ
-                        rData.project = prjReq.project.projectname
-                        requestid = "%d:%s" % (curr_regid, prjReq.project.projectname)
+            rData = RegistrData(registration = prjReq.registration)
+            curr_regid = prjReq.registration_id
+            req_key = (curr_regid, prjReq.project.projectname)
+            
+            if prjReq.flowstatus == PSTATUS_RENEW_MEMB:
 
-                else:
+                rData.code = RegistrData.USR_RENEW
+                rData.project = prjReq.project.projectname
+                rData.notes = prjReq.notes
 
-                    if curr_regid in regid_pending:
-                        rData.code = RegistrData.NEW_USR_NEW_PRJ
-                    else:
-                        rData.code = RegistrData.EX_USR_NEW_PRJ
+            elif prjReq.flowstatus == PSTATUS_RENEW_ADMIN:
+
+                rData.code = RegistrData.PRJADM_RENEW
+                rData.project = prjReq.project.projectname
+                rData.notes = prjReq.notes
+
+            elif prjReq.project.projectid:
+
+                if curr_regid in regid_pending:
+                    rData.code = RegistrData.NEW_USR_EX_PRJ
+                    req_key = (curr_regid, "")
+                else:
+                    rData.code = RegistrData.EX_USR_EX_PRJ
                     rData.project = prjReq.project.projectname
-                    requestid = "%d:%s" % (curr_regid, prjReq.project.projectname)
-                    if prjReq.project.status == PRJ_PRIVATE:
-                        rData.project += " (%s)" % _("Private")
 
-                rData.requestid = requestid
-                
-                if not requestid in reqTable:
-                    reqTable[requestid] = rData
+            else:
+
+                if curr_regid in regid_pending:
+                    rData.code = RegistrData.NEW_USR_NEW_PRJ
+                else:
+                    rData.code = RegistrData.EX_USR_NEW_PRJ
+                rData.project = prjReq.project.projectname
+                if prjReq.project.status == PRJ_PRIVATE:
+                    rData.project += " (%s)" % _("Private")
+
+            rData.requestid = "%d:%s" % req_key
+            
+            if not req_key in reqTable:
+                reqTable[req_key] = rData
+
+        return reqTable
+
+    def get_data(self):
 
-        result = reqTable.values()
-        result.sort()
-        return result
+        page_size = get_page_size(self.request)
+        marker = self.request.GET.get(OperationTable._meta.pagination_param, None)
+        prev_marker = self.request.GET.get(OperationTable._meta.prev_pagination_param, None)
+
+        prev_key = self._parse_marker(prev_marker)
+        next_key = None if prev_key else self._parse_marker(marker)
+        reverse = prev_key is not None
+        key = prev_key if reverse else next_key
+
+        #
+        # Each registration yields at least one request, one more registration
+        # is loaded for the request of the marker
+        #
+        regids = self._get_page_regids(key, reverse, page_size + 2)
+        reqTable = self._load_requests(regids)
+
+        if reverse:
+            keys = sorted(x for x in reqTable if x < key)
+            self._prev = len(keys) > page_size
+            self._more = True
+            keys = keys[-page_size:]
+        else:
+            keys = sorted(x for x in reqTable if key is None or x > key)
+            self._prev = key is not None
+            self._more = len(keys) > page_size
+            keys = keys[:page_size]
+
+        return [ reqTable[x] for x in keys ]
 
 class AbstractCheckView(forms.ModalFormView):
 
@@ -39,6 +39,8 @@ from openstack_auth_shib.models import RSTATUS_REMINDACK
 
 from openstack_auth_shib.notifications import notifyUser
 from openstack_auth_shib.notifications import notifyAdmin
+from openstack_auth_shib.notifications import NotificationBatch
+from openstack_auth_shib.notifications import DeferredNotifications
 from openstack_auth_shib.notifications import SUBSCR_OK_TYPE
 from openstack_auth_shib.notifications import SUBSCR_NO_TYPE
 from openstack_auth_shib.notifications import MEMBER_REMOVED
@@ -147,17 +149,18 @@ class ApproveSubscrForm(forms.SelfHandlingForm):
                 #
                 prj_req.delete()
 
-            #
-            # send notification to the user
-            #
-            noti_params = {
-                'username': user_name,
-                'project' : project_name
-            }
+                #
+                # send notification to the user, after commit
+                #
+                noti_params = {
+                    'username': user_name,
+                    'project' : project_name
+                }
 
-            notifyUser(request=self.request, rcpt=member_email, action=SUBSCR_OK_TYPE, context=noti_params,
-                       dst_user_id=member_id)
-            notifyAdmin(request=self.request, action=SUBSCR_OK_TYPE, context=noti_params)
+                with DeferredNotifications():
+                    notifyUser(request=self.request, rcpt=member_email, action=SUBSCR_OK_TYPE,
+                               context=noti_params, dst_user_id=member_id)
+                    notifyAdmin(request=self.request, action=SUBSCR_OK_TYPE, context=noti_params)
 
         except:
             exceptions.handle(request)
@@ -218,9 +221,10 @@ class RejectSubscrForm(forms.SelfHandlingForm):
                 'notes' : data['reason']
             }
 
-            notifyUser(request=self.request, rcpt=member_email, action=SUBSCR_NO_TYPE, context=noti_params,
-                       dst_user_id=member_id)
-            notifyAdmin(request=self.request, action=SUBSCR_NO_TYPE, context=noti_params)
+            with NotificationBatch():
+                notifyUser(request=self.request, rcpt=member_email, action=SUBSCR_NO_TYPE, context=noti_params,
+                           dst_user_id=member_id)
+                notifyAdmin(request=self.request, action=SUBSCR_NO_TYPE, context=noti_params)
 
         except:
             exceptions.handle(request)
@@ -304,9 +308,10 @@ class RenewSubscrForm(forms.SelfHandlingForm):
                 'expiration' : data['expiration'].strftime("%d %B %Y")
             }
 
-            notifyUser(request=request, rcpt=user_mail, action=USER_RENEWED_TYPE,
-                       context=noti_params, dst_user_id=user_reg.userid)
-            notifyAdmin(request=request, action=USER_RENEWED_TYPE, context=noti_params)
+            with NotificationBatch():
+                notifyUser(request=request, rcpt=user_mail, action=USER_RENEWED_TYPE,
+                           context=noti_params, dst_user_id=user_reg.userid)
+                notifyAdmin(request=request, action=USER_RENEWED_TYPE, context=noti_params)
 
         except:
             LOG.error("Cannot renew user", exc_info=True)
@@ -28,7 +28,7 @@ from openstack_auth_shib.models import EMail
 from openstack_auth_shib.models import Expiration
 from openstack_auth_shib.notifications import notifyUser
 from openstack_auth_shib.notifications import USER_PURGED_TYPE
-from openstack_auth_shib.utils import get_prjman_ids
+from openstack_auth_shib.utils import get_prjman_ids_many
 
 from horizon import messages
 
@@ -47,12 +47,18 @@ class DeleteUsersAction(baseTables.DeleteUsersAction):
         with transaction.atomic():
 
             critic_prjs = list()
-            for e_item in Expiration.objects.filter(registration__userid=obj_id):
+            exp_list = list(Expiration.objects.for_users([ obj_id ]).select_related('project'))
+            #
+            # The cache may be stale in this process, see invalidate_prjman_cache
+            #
+            prjman_table = get_prjman_ids_many([ x.project.projectid for x in exp_list ],
+                                               use_cache=False)
+            for e_item in exp_list:
 
-                prj_man_ids = get_prjman_ids(request, e_item.project.projectid)
+                prj_man_ids = prjman_table.get(e_item.project.projectid, list())
 
                 if len(prj_man_ids) == 1 and prj_man_ids[0] == obj_id:
-                    critic_prjs.append(e_item.project.projectname)
+                    critic_prjs.append(e_item.project_id)
 
             if len(critic_prjs) > 0:
                 msg = _("User is the unique admin for %s") % ", ".join(critic_prjs)
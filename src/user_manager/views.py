@@ -68,7 +68,7 @@ class RenewView(forms.ModalFormView):
         if not hasattr(self, "_object"):
             try:
 
-                self._object = Expiration.objects.filter(registration__userid=self.kwargs['user_id'])
+                self._object = Expiration.objects.for_users([ self.kwargs['user_id'] ])
 
             except Exception:
                 LOG.error("Renew error", exc_info=True)
@@ -88,8 +88,11 @@ class RenewView(forms.ModalFormView):
         result = dict()
         result['userid'] = self.kwargs['user_id']
         
+        #
+        # project_id is the project name (primary key of Project)
+        #
         for exp_item in self.get_object():
-            result['prj_%s' % exp_item.project.projectname] = exp_item.expdate
+            result['prj_%s' % exp_item.project_id] = exp_item.expdate
 
         return result
 